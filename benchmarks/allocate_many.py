@@ -0,0 +1,55 @@
+"""
+Compares allocating a large order import one line at a time against
+Product.allocate_many.
+
+    python benchmarks/allocate_many.py [batches] [lines]
+"""
+
+import random
+import sys
+import time
+from datetime import date, timedelta
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def make_product(batches: int, seed: int = 0) -> Product:
+    rng = random.Random(seed)
+    return Product(
+        "BUSY-LAMP",
+        [
+            Batch(
+                f"batch-{i}",
+                "BUSY-LAMP",
+                rng.randint(1, 3000),
+                date.today() + timedelta(days=rng.randint(0, 500)),
+            )
+            for i in range(batches)
+        ],
+    )
+
+
+def main(batches: int = 300, lines: int = 100_000):
+    rng = random.Random(1)
+    order_lines = [
+        OrderLine(f"order-{i}", "BUSY-LAMP", rng.randint(1, 10))
+        for i in range(lines)
+    ]
+
+    product = make_product(batches)
+    start = time.perf_counter()
+    for line in order_lines:
+        product.allocate(line)
+    one_by_one = time.perf_counter() - start
+
+    product = make_product(batches)
+    start = time.perf_counter()
+    product.allocate_many(order_lines)
+    in_bulk = time.perf_counter() - start
+
+    print(f"{lines} lines over {batches} batches")
+    print(f"  allocate:       {one_by_one:8.3f} s")
+    print(f"  allocate_many:  {in_bulk:8.3f} s")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:3]))
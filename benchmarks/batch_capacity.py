@@ -0,0 +1,39 @@
+"""
+Compares capacity checks on a batch holding many allocated lines against
+summing over its allocations, which is what every check used to cost.
+
+    python benchmarks/batch_capacity.py [lines]
+"""
+
+import sys
+import timeit
+from allocation.domain.model import Batch, OrderLine
+
+
+def make_busy_batch(lines: int) -> Batch:
+    batch = Batch("batch-001", "BUSY-LAMP", lines * 2, eta=None)
+    for i in range(lines):
+        batch.allocate(OrderLine(f"order-{i}", "BUSY-LAMP", 1))
+    return batch
+
+
+def main(lines: int = 50_000, number: int = 1_000):
+    batch = make_busy_batch(lines)
+    line = OrderLine("order-new", "BUSY-LAMP", 1)
+
+    running_total = timeit.timeit(
+        lambda: batch.can_allocate(line), number=number
+    )
+    summed = timeit.timeit(
+        lambda: batch._purchased_quantity
+        - sum(l.qty for l in batch._allocations)
+        >= line.qty,
+        number=number,
+    )
+    print(f"{lines} allocated lines, {number} capacity checks")
+    print(f"  running total:   {running_total * 1e6 / number:10.2f} us/check")
+    print(f"  summing lines:   {summed * 1e6 / number:10.2f} us/check")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,97 @@
+"""
+Measures the memory held by a large product's order lines and batches when
+each row brings its own copies of the sku and order id strings, as rows
+from a database driver do, against the same objects without interning.
+
+    python benchmarks/line_memory.py [lines] [lines per batch]
+"""
+
+import sys
+import tracemalloc
+from dataclasses import dataclass
+from allocation.domain.model import Batch, OrderLine
+
+
+@dataclass(unsafe_hash=True)
+class UninternedOrderLine:
+    order_id: str
+    sku: str
+    qty: int
+
+
+class UninternedBatch(Batch):
+    def __init__(self, ref, sku, qty, eta) -> None:
+        super().__init__(ref, sku, qty, eta)
+        self.sku = sku
+
+
+def fresh(*parts: str) -> str:
+    # a new string object every time, like a driver would hand back
+    return "".join(parts)
+
+
+def line_rows(lines: int):
+    for i in range(lines):
+        yield fresh("order-", str(i % 1000)), fresh("BUSY-", "LAMP"), 1
+
+
+def allocated_bytes(make, count: int) -> int:
+    tracemalloc.start()
+    held = make(count)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    return size
+
+
+def make_lines(line_class):
+    def make(lines: int):
+        held = [line_class(*row) for row in line_rows(lines)]
+        for line in held:
+            hash(line)
+        return held
+
+    return make
+
+
+def make_batches(batch_class, line_class, lines_per_batch: int):
+    # lines go into each batch's allocations set, which is most of what a
+    # batch holding lines costs
+    def make(batches: int):
+        held = []
+        for i in range(batches):
+            batch = batch_class(
+                fresh("batch-", str(i)), fresh("BUSY-", "LAMP"), 10**6, None
+            )
+            for row in line_rows(lines_per_batch):
+                batch.allocate(line_class(*row))
+            held.append(batch)
+        return held
+
+    return make
+
+
+def main(lines: int = 200_000, lines_per_batch: int = 20):
+    before = allocated_bytes(make_lines(UninternedOrderLine), lines)
+    after = allocated_bytes(make_lines(OrderLine), lines)
+    print(f"{lines} order lines")
+    print(f"  uninterned:  {before / lines:8.1f} bytes/line")
+    print(f"  interned:    {after / lines:8.1f} bytes/line")
+
+    batches = lines // lines_per_batch
+    before = allocated_bytes(
+        make_batches(UninternedBatch, UninternedOrderLine, lines_per_batch),
+        batches,
+    )
+    after = allocated_bytes(
+        make_batches(Batch, OrderLine, lines_per_batch), batches
+    )
+    empty = allocated_bytes(make_batches(Batch, OrderLine, 0), batches)
+    print(f"{batches} batches of {lines_per_batch} allocated lines")
+    print(f"  uninterned:  {before / batches:8.1f} bytes/batch")
+    print(f"  interned:    {after / batches:8.1f} bytes/batch")
+    print(f"  no lines:    {empty / batches:8.1f} bytes/batch")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:3]))
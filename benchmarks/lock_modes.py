@@ -0,0 +1,97 @@
+"""
+Compares allocation throughput against Postgres with product versions alone
+(REPEATABLE READ, conflicts retried by the message bus) and with products
+locked as they're read (READ COMMITTED plus SELECT ... FOR UPDATE). Workers
+all allocate against the same few skus, so most transactions contend.
+
+    python benchmarks/lock_modes.py [workers] [orders per worker] [skus]
+"""
+
+import sys
+import time
+import uuid
+from collections import deque
+from concurrent import futures
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap, config
+from allocation.adapters import orm
+from allocation.adapters.notifications import AbstractNotifications
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+MODES = [
+    ("versions only", "REPEATABLE READ", None),
+    ("for update", "READ COMMITTED", "update"),
+    ("for update nowait", "READ COMMITTED", "nowait"),
+]
+
+
+class NoNotifications(AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+def run(isolation_level, lock_mode, workers, orders, skus):
+    session_factory = sessionmaker(
+        bind=create_engine(
+            config.get_postgres_uri(),
+            isolation_level=isolation_level,
+            pool_size=workers,
+        )
+    )
+    run_id = uuid.uuid4().hex[:6]
+    sku_names = [f"LOCKS-{run_id}-{i}" for i in range(skus)]
+    setup = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        message_queue_factory=deque,
+        publish=lambda *args, **kwargs: None,
+        notifications=NoNotifications(),
+    )
+    for sku in sku_names:
+        setup.handle(commands.CreateBatch(f"{sku}-batch", sku, 10**9, None))
+
+    failures = []
+
+    def worker(n):
+        # a bus and unit of work per worker, as each process would have
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(
+                session_factory, lock_mode=lock_mode
+            ),
+            message_queue_factory=deque,
+            publish=lambda *args, **kwargs: None,
+            notifications=NoNotifications(),
+        )
+        for i in range(orders):
+            sku = sku_names[(n + i) % skus]
+            try:
+                bus.handle(commands.Allocate(f"order-{n}-{i}", sku, 1))
+            except Exception as e:
+                failures.append(e)
+
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(workers) as executor:
+        list(executor.map(worker, range(workers)))
+    return time.perf_counter() - start, len(failures)
+
+
+def main(workers: int = 8, orders: int = 50, skus: int = 2):
+    engine = create_engine(config.get_postgres_uri())
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+
+    total = workers * orders
+    print(f"{workers} workers, {total} orders over {skus} skus")
+    for name, isolation_level, lock_mode in MODES:
+        elapsed, failed = run(
+            isolation_level, lock_mode, workers, orders, skus
+        )
+        rate = total / elapsed
+        print(f"  {name:18} {rate:8.1f} orders/s  {failed} failed")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:4]))
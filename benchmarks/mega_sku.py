@@ -0,0 +1,56 @@
+"""
+Compares allocation latency for a product with tens of thousands of batches
+when allocating from batch objects and from NumPy columns. Most batches are
+nearly used up, so the first batch an order fits in is far down the order.
+
+    python benchmarks/mega_sku.py [batches] [lines]
+"""
+
+import random
+import sys
+import time
+from datetime import date, timedelta
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def make_product(batches: int, columnar: bool) -> Product:
+    rng = random.Random(0)
+    product = Product(
+        "MEGA-LAMP",
+        [
+            Batch(
+                f"batch-{i}",
+                "MEGA-LAMP",
+                5000 if rng.random() < 0.001 else 2,
+                date.today() + timedelta(days=rng.randint(0, 2000)),
+            )
+            for i in range(batches)
+        ],
+    )
+    product.COLUMNAR_THRESHOLD = 0 if columnar else batches + 1
+    return product
+
+
+def time_allocations(product: Product, lines: int) -> float:
+    rng = random.Random(1)
+    order_lines = [
+        OrderLine(f"order-{i}", "MEGA-LAMP", rng.randint(3, 10))
+        for i in range(lines)
+    ]
+    product.allocate(OrderLine("warm-up", "MEGA-LAMP", 1))
+    start = time.perf_counter()
+    for line in order_lines:
+        product.allocate(line)
+    return time.perf_counter() - start
+
+
+def main(batches: int = 20_000, lines: int = 2_000):
+    by_object = time_allocations(make_product(batches, False), lines)
+    by_column = time_allocations(make_product(batches, True), lines)
+    print(f"{lines} allocations against {batches} batches")
+    print(f"  batch objects:  {by_object * 1e6 / lines:10.1f} us/allocation")
+    print(f"  columns:        {by_column * 1e6 / lines:10.1f} us/allocation")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:3]))
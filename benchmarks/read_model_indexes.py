@@ -0,0 +1,100 @@
+"""
+Grows allocations_view step by step and times the read model's lookup by
+order and delete by order and sku at each size, with and without the
+schema's indexes, printing the query plan used. Runs against an in-memory
+SQLite database unless given a database URI.
+
+    python benchmarks/read_model_indexes.py [rows] [database uri]
+"""
+
+import random
+import sys
+import time
+from sqlalchemy import create_engine, text
+from allocation.adapters import orm
+
+LOOKUP = "SELECT sku, batch_ref FROM allocations_view WHERE order_id = :o"
+DELETE = "DELETE FROM allocations_view WHERE sku = :s AND order_id = :o"
+SAMPLES = 200
+
+
+def fill(connection, start: int, end: int) -> None:
+    connection.execute(
+        orm.allocations_view.insert(),
+        [
+            dict(order_id=f"order-{i}", sku=f"SKU-{i % 5000}", batch_ref="b")
+            for i in range(start, end)
+        ],
+    )
+
+
+def time_queries(connection, rows: int) -> tuple:
+    rng = random.Random(rows)
+    picks = [rng.randrange(rows) for _ in range(SAMPLES)]
+    start = time.perf_counter()
+    for i in picks:
+        connection.execute(text(LOOKUP), dict(o=f"order-{i}")).all()
+    lookup = (time.perf_counter() - start) / SAMPLES
+    start = time.perf_counter()
+    for i in picks:
+        connection.execute(
+            text(DELETE), dict(s=f"SKU-{i % 5000}", o=f"order-{i}")
+        )
+    delete = (time.perf_counter() - start) / SAMPLES
+    # put the deleted rows back so every step measures the full size
+    connection.execute(
+        orm.allocations_view.insert(),
+        [
+            dict(order_id=f"order-{i}", sku=f"SKU-{i % 5000}", batch_ref="b")
+            for i in set(picks)
+        ],
+    )
+    return lookup, delete
+
+
+def plan(connection, query: str) -> str:
+    explain = (
+        "EXPLAIN QUERY PLAN "
+        if connection.dialect.name == "sqlite"
+        else "EXPLAIN "
+    )
+    rows = connection.execute(text(explain + query), dict(o="x", s="y"))
+    return "; ".join(str(row[-1]) for row in rows)
+
+
+def run(uri: str, max_rows: int, indexed: bool) -> None:
+    engine = create_engine(uri)
+    orm.allocations_view.drop(engine, checkfirst=True)
+    orm.allocations_view.create(engine)
+    if not indexed:
+        for index in orm.allocations_view.indexes:
+            index.drop(engine)
+
+    print("with indexes" if indexed else "without indexes")
+    with engine.begin() as connection:
+        print(f"  lookup plan: {plan(connection, LOOKUP)}")
+        print(f"  delete plan: {plan(connection, DELETE)}")
+    rows = 0
+    size = 10_000
+    while size <= max_rows:
+        with engine.begin() as connection:
+            fill(connection, rows, size)
+            rows = size
+            lookup, delete = time_queries(connection, rows)
+        print(
+            f"  {rows:>9} rows  lookup {lookup * 1e6:10.1f} us"
+            f"  delete {delete * 1e6:10.1f} us"
+        )
+        size *= 10
+    orm.allocations_view.drop(engine)
+
+
+def main(max_rows: int = 1_000_000, uri: str = "sqlite://"):
+    run(uri, max_rows, indexed=True)
+    # unindexed scans get slow quickly, so stop them an order earlier
+    run(uri, max(max_rows // 10, 10_000), indexed=False)
+
+
+if __name__ == "__main__":
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    main(max_rows, *sys.argv[2:3])
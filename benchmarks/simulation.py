@@ -0,0 +1,68 @@
+"""
+Compares replaying an order stream through Snapshot.simulate against
+allocating the same lines on copies of the products.
+
+    python benchmarks/simulation.py [lines]
+"""
+
+import copy
+import random
+import sys
+import time
+from datetime import date, timedelta
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.simulation import Snapshot
+
+SKUS = [f"SKU-{i}" for i in range(20)]
+# stock for about half of what the default stream orders of each sku, so
+# that stock-outs are part of what's measured
+BATCHES = 20
+
+
+def make_products():
+    rng = random.Random(0)
+    return [
+        Product(
+            sku,
+            [
+                Batch(
+                    f"{sku}-batch-{i}",
+                    sku,
+                    rng.randint(100, 5000),
+                    date.today() + timedelta(days=rng.randint(0, 300)),
+                )
+                for i in range(BATCHES)
+            ],
+        )
+        for sku in SKUS
+    ]
+
+
+def main(lines: int = 200_000):
+    rng = random.Random(1)
+    stream = [
+        OrderLine(f"order-{i}", rng.choice(SKUS), rng.randint(1, 20))
+        for i in range(lines)
+    ]
+    products = make_products()
+    snapshot = Snapshot(products)
+
+    start = time.perf_counter()
+    result = snapshot.simulate(stream)
+    simulated = time.perf_counter() - start
+
+    start = time.perf_counter()
+    copies = {p.sku: p for p in copy.deepcopy(products)}
+    for line in stream:
+        copies[line.sku].allocate(line)
+    allocated = time.perf_counter() - start
+
+    print(f"{lines} lines over {len(SKUS)} skus")
+    print(f"  fill rate:         {result.fill_rate():8.3f}")
+    print(f"  out of stock:      {len(result.out_of_stock):8d} lines")
+    print(f"  Snapshot.simulate: {simulated:8.3f} s")
+    print(f"  Product.allocate:  {allocated:8.3f} s")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:2]))
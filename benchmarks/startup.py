@@ -0,0 +1,49 @@
+"""
+Times how long a fresh worker process takes to import the Flask app,
+which bootstraps the message bus, with the database, Redis and mail
+server all pointed at hosts that don't exist. Nothing connects until
+first use, so this boots fast and doesn't fail.
+
+    python benchmarks/startup.py [runs]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+
+BOOT = (
+    "import time\n"
+    "start = time.perf_counter()\n"
+    "import allocation.entrypoints.flask_app\n"
+    "print(time.perf_counter() - start)\n"
+)
+
+
+def main(runs: int = 10):
+    env = dict(
+        os.environ,
+        DB_HOST="db.invalid",
+        REDIS_HOST="redis.invalid",
+        EMAIL_HOST="mail.invalid",
+    )
+    timings = []
+    for _ in range(runs):
+        boot = subprocess.run(
+            [sys.executable, "-c", BOOT],
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if boot.returncode:
+            print(boot.stderr)
+            sys.exit("worker failed to boot")
+        timings.append(float(boot.stdout.split()[-1]))
+
+    print(f"{runs} boots with no services reachable")
+    print(f"  median {statistics.median(timings) * 1000:8.1f} ms")
+    print(f"  max    {max(timings) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:2]))
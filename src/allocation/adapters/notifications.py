@@ -1,7 +1,9 @@
 from abc import ABC, abstractmethod
 import smtplib
+import threading
 
 from allocation import config
+from allocation.adapters.process_local import ProcessLocal
 
 
 class AbstractNotifications(ABC):
@@ -16,13 +18,24 @@ DEFAULT_PORT = config.get_email_host_and_port()["port"]
 
 class EmailNotifications(AbstractNotifications):
     def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT) -> None:
-        self.server = smtplib.SMTP(smtp_host, port)
-        self.server.noop()
+        # connects when the first email goes out, so that starting up
+        # doesn't depend on the mail server being there. The connection is
+        # shared by every thread in the process but smtplib isn't safe for
+        # that, so it comes with a lock to send through it one at a time
+        self._server = ProcessLocal(
+            lambda: (smtplib.SMTP(smtp_host, port), threading.Lock())
+        )
+
+    @property
+    def server(self) -> smtplib.SMTP:
+        return self._server.get()[0]
 
     def send(self, destination, message):
         msg = f"Subject: allocation service notification\n {message}"
-        self.server.sendmail(
-            from_addr="allocation@example.com",
-            to_addrs=[destination],
-            msg=msg,
-        )
+        server, lock = self._server.get()
+        with lock:
+            server.sendmail(
+                from_addr="allocation@example.com",
+                to_addrs=[destination],
+                msg=msg,
+            )
@@ -1,3 +1,4 @@
+import sys
 from sqlalchemy import (
     Table,
     MetaData,
@@ -6,9 +7,25 @@ from sqlalchemy import (
     String,
     Date,
     ForeignKey,
+    Index,
     event,
+    func,
+    select,
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import (
+    joinedload,
+    lazyload,
+    object_session,
+    relationship,
+    selectinload,
+    subqueryload,
+)
+from sqlalchemy.orm.attributes import (
+    PASSIVE_NO_INITIALIZE,
+    get_history,
+    set_committed_value,
+)
+from sqlalchemy.orm.dynamic import AppenderQuery
 from sqlalchemy.orm.decl_api import registry
 from allocation.domain import model
 
@@ -22,6 +39,7 @@ order_lines = Table(
     Column("sku", String(255), nullable=False),
     Column("qty", Integer, nullable=False),
     Column("order_id", String(255), nullable=False),
+    Index("ix_order_lines_order_id", "order_id"),
 )
 
 products = Table(
@@ -38,7 +56,13 @@ batches = Table(
     Column("reference", String(255), nullable=False),
     Column("sku", ForeignKey("products.sku")),
     Column("_purchased_quantity", Integer, nullable=False),
+    # the sum of the allocated lines' quantities, kept up to date by the
+    # model so that nothing needs the lines to know what's left in a batch
+    Column("_allocated_quantity", Integer, nullable=False, server_default="0"),
     Column("eta", Date, nullable=True),
+    # batches are only ever looked up by sku, and references are unique
+    # within a product
+    Index("ux_batches_sku_reference", "sku", "reference", unique=True),
 )
 
 
@@ -48,6 +72,13 @@ allocations = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("order_line_id", ForeignKey("order_lines.id")),
     Column("batch_id", ForeignKey("batches.id")),
+    Index(
+        "ux_allocations_batch_id_order_line_id",
+        "batch_id",
+        "order_line_id",
+        unique=True,
+    ),
+    Index("ix_allocations_order_line_id", "order_line_id"),
 )
 
 allocations_view = Table(
@@ -56,10 +87,60 @@ allocations_view = Table(
     Column("order_id", String(255), nullable=False),
     Column("sku", String(255), nullable=False),
     Column("batch_ref", String(255), nullable=False),
+    # serves lookups by order and deletes by order and sku alike
+    Index("ix_allocations_view_order_id_sku", "order_id", "sku"),
 )
 
 
-def start_mappers():
+# how a product's batches get loaded; any of these but "select" loads them
+# in a fixed number of round trips
+LOADING_STRATEGIES = {
+    "selectin": selectinload,
+    "joined": joinedload,
+    "subquery": subqueryload,
+    "select": lazyload,
+}
+DEFAULT_LOADING_STRATEGY = "selectin"
+
+
+class AllocationsQuery(AppenderQuery):
+    """
+    A batch's allocations as the mappers give them: a query for its lines
+    rather than all of them loaded, with as much of a set's interface as
+    the model uses. Adding a line doesn't load the others, and checking
+    for one only looks for that one.
+    """
+
+    def add(self, line: model.OrderLine) -> None:
+        self.append(line)
+
+    def pop(self) -> model.OrderLine:
+        line = next(iter(self.limit(1)))
+        self.remove(line)
+        return line
+
+    def __contains__(self, line) -> bool:
+        added, _, deleted = get_history(
+            self.instance, "_allocations", PASSIVE_NO_INITIALIZE
+        )
+        if line in added:
+            return True
+        session = object_session(self.instance)
+        if line in deleted or session is None:
+            return False
+        # what's been added or removed since the last flush is known here
+        # already, so there's nothing to flush for
+        with session.no_autoflush:
+            query = self.filter_by(
+                order_id=line.order_id, sku=line.sku, qty=line.qty
+            )
+            return query.first() is not None
+
+    def __len__(self) -> int:
+        return self.count()
+
+
+def start_mappers(loading_strategy: str = DEFAULT_LOADING_STRATEGY):
     lines_mapper = mapper_registry.map_imperatively(
         model.OrderLine, order_lines
     )
@@ -67,18 +148,69 @@ def start_mappers():
         model.Batch,
         batches,
         properties={
+            # a batch's whole history of lines, which nothing needs to know
+            # what's left in it, so it's never loaded with the batch
             "_allocations": relationship(
-                lines_mapper, secondary=allocations, collection_class=set
-            )
+                lines_mapper,
+                secondary=allocations,
+                lazy="dynamic",
+                query_class=AllocationsQuery,
+            ),
         },
     )
     mapper_registry.map_imperatively(
         model.Product,
         products,
-        properties={"batches": relationship(batches_mapper)},
+        properties={
+            "batches": relationship(batches_mapper, lazy=loading_strategy)
+        },
+        # the model bumps version_number on every change; the mapper makes
+        # sure the version it started from is still the one in the database
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
+    )
+
+
+def reconcile_allocated_quantities(connection) -> None:
+    """
+    Recompute every batch's allocated quantity from its allocations, e.g.
+    to backfill the column on an existing database.
+    """
+    allocated = (
+        select(func.coalesce(func.sum(order_lines.c.qty), 0))
+        .select_from(allocations.join(order_lines))
+        .where(allocations.c.batch_id == batches.c.id)
+        .scalar_subquery()
     )
+    connection.execute(batches.update().values(_allocated_quantity=allocated))
+
+
+def load_product_graph(loading_strategy: str):
+    """Query options loading a product's batches."""
+    return LOADING_STRATEGIES[loading_strategy](model.Product.batches)
 
 
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
     product.events = []
+    product.invalidate_indexes()
+
+
+@event.listens_for(model.Product, "refresh")
+@event.listens_for(model.Product, "expire")
+def receive_refresh(product, *_):
+    # the batches, or their quantities, may not be what was indexed
+    product.invalidate_indexes()
+
+
+@event.listens_for(model.OrderLine, "load")
+def receive_order_line_load(line, _):
+    # the same as OrderLine.__post_init__, which loading doesn't call
+    set_committed_value(line, "order_id", sys.intern(line.order_id))
+    set_committed_value(line, "sku", sys.intern(line.sku))
+
+
+@event.listens_for(model.Batch, "load")
+def receive_batch_load(batch, _):
+    if batch.sku is not None:
+        set_committed_value(batch, "sku", sys.intern(batch.sku))
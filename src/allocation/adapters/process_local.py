@@ -0,0 +1,47 @@
+import os
+import threading
+import weakref
+from typing import Callable, Generic, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+_instances = weakref.WeakSet()  # type: weakref.WeakSet[ProcessLocal]
+# what a forked process inherited from its parent and then replaced; never
+# let go of, since finalizing a client or a pool closes its connections,
+# and with them the sockets the parent is still using
+_inherited = []  # type: List[object]
+
+
+class ProcessLocal(Generic[T]):
+    """
+    A client, pool or engine created on first use rather than at import,
+    and created again in a process forked after that, so that workers of a
+    pre-fork server never share sockets with their parent or each other.
+    """
+
+    def __init__(self, factory: Callable[[], T]) -> None:
+        self._factory = factory
+        self._value = None  # type: Optional[T]
+        self._pid = None  # type: Optional[int]
+        self._lock = threading.Lock()
+        _instances.add(self)
+
+    def get(self) -> T:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self._value is not None:
+                        _inherited.append(self._value)
+                    self._value = self._factory()
+                    self._pid = os.getpid()
+        return self._value
+
+
+def _after_fork_in_child() -> None:
+    # a lock some other thread held at the time of the fork would stay
+    # locked in the child for good
+    for instance in list(_instances):
+        instance._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,58 @@
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple
+from sqlalchemy import tuple_
+from allocation.adapters import orm
+from allocation.domain import events
+
+# rows per INSERT or DELETE statement, to stay within the database's limit
+# on bound parameters
+STATEMENT_ROWS = 250
+
+
+def apply(session_for: Callable[[str], object], messages: Iterable) -> None:
+    """
+    Write the Allocated and Deallocated events among the messages to
+    allocations_view, through the session for each event's sku, as
+    multi-row DELETEs and INSERTs. Nothing is committed.
+    """
+    # a Deallocated removes every row of its order and sku, so all that
+    # matters for each of those is whether one came up, and which rows
+    # were allocated after the last one
+    cleared = set()  # type: Set[Tuple[str, str]]
+    rows = defaultdict(list)  # type: Dict[Tuple[str, str], List[dict]]
+    for message in messages:
+        if isinstance(message, events.Deallocated):
+            key = (message.order_id, message.sku)
+            cleared.add(key)
+            rows.pop(key, None)
+        elif isinstance(message, events.Allocated):
+            rows[message.order_id, message.sku].append(
+                dict(
+                    order_id=message.order_id,
+                    sku=message.sku,
+                    batch_ref=message.batch_ref,
+                )
+            )
+
+    view = orm.allocations_view
+    cleared_in = defaultdict(list)  # type: Dict[object, List]
+    rows_in = defaultdict(list)  # type: Dict[object, List[dict]]
+    for order_id, sku in cleared:
+        cleared_in[session_for(sku)].append((order_id, sku))
+    for (_, sku), key_rows in rows.items():
+        rows_in[session_for(sku)].extend(key_rows)
+    for session, keys in cleared_in.items():
+        for chunk in chunks(keys):
+            session.execute(
+                view.delete().where(
+                    tuple_(view.c.order_id, view.c.sku).in_(chunk)
+                )
+            )
+    for session, session_rows in rows_in.items():
+        for chunk in chunks(session_rows):
+            session.execute(view.insert().values(chunk))
+
+
+def chunks(items: List, size: int = STATEMENT_ROWS) -> Iterator[List]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
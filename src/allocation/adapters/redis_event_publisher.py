@@ -2,13 +2,23 @@ import json
 import logging
 from dataclasses import asdict
 import redis
+import redis.asyncio
 from allocation import config
+from allocation.adapters.process_local import ProcessLocal
 from allocation.domain import events
 
-r = redis.Redis(**config.get_redis_host_and_port())
+r = ProcessLocal(lambda: redis.Redis(**config.get_redis_host_and_port()))
+async_r = ProcessLocal(
+    lambda: redis.asyncio.Redis(**config.get_redis_host_and_port())
+)
 logger = logging.getLogger(__name__)
 
 
 def publish_message(channel, event: events.Event):
     logger.debug(f"publishing: channel={channel}, event={event}")
-    r.publish(channel, json.dumps(asdict(event)))
+    r.get().publish(channel, json.dumps(asdict(event)))
+
+
+async def publish_message_async(channel, event: events.Event):
+    logger.debug(f"publishing: channel={channel}, event={event}")
+    await async_r.get().publish(channel, json.dumps(asdict(event)))
@@ -1,22 +1,117 @@
 from abc import ABC, abstractmethod
-from typing import Set
-from allocation.domain import model
+from collections import OrderedDict, defaultdict, deque
+import itertools
+import threading
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Union,
+)
+from sqlalchemy import select
+from allocation.adapters import orm
+from allocation.domain import commands, events, model
+
+Message = Union[events.Event, commands.Command]
+
+
+class Outbox:
+    """
+    The messages raised by the products a repository has handed out, in
+    the order they were raised. Products' events lists feed it as they're
+    appended to, so draining it never has to look at a product.
+    """
+
+    def __init__(self) -> None:
+        self._messages = deque()  # type: Deque[Message]
+        # the events lists appended to since the last drain
+        self._dirty = []  # type: List[_OutboxEvents]
+        self._peeked = 0
+
+    def track(self, product: model.Product) -> None:
+        if getattr(product.events, "outbox", None) is self:
+            return
+        product.events = _OutboxEvents(self, product.events)
+
+    def peek_new(self) -> List[Message]:
+        """
+        The messages raised since the last peek_new() or drain(), left in
+        the outbox.
+        """
+        messages = list(itertools.islice(self._messages, self._peeked, None))
+        self._peeked = len(self._messages)
+        return messages
+
+    def drain(self) -> Deque[Message]:
+        messages, self._messages = self._messages, deque()
+        self._peeked = 0
+        for product_events in self._dirty:
+            product_events.drained()
+        self._dirty = []
+        return messages
+
+    def _raised(self, product_events: "_OutboxEvents", messages) -> None:
+        if not product_events:
+            self._dirty.append(product_events)
+        self._messages.extend(messages)
+
+
+class _OutboxEvents(list):
+    # a product's events list that also hands everything appended to it to
+    # an outbox; it's emptied when the outbox is drained
+    def __init__(self, outbox: Outbox, messages: Iterable[Message] = ()):
+        super().__init__()
+        self.outbox = outbox
+        self.extend(messages)
+
+    def append(self, message: Message) -> None:
+        self.outbox._raised(self, [message])
+        super().append(message)
+
+    def extend(self, messages: Iterable[Message]) -> None:
+        messages = list(messages)
+        if messages:
+            self.outbox._raised(self, messages)
+            super().extend(messages)
+
+    def __iadd__(self, messages: Iterable[Message]):
+        self.extend(messages)
+        return self
+
+    def drained(self) -> None:
+        super().clear()
 
 
 class AbstractRepository(ABC):
     def __init__(self):
         self.seen = set()  # type: Set[model.Product]
+        self.outbox = Outbox()
 
     def add(self, product: model.Product) -> None:
         self._add(product)
-        self.seen.add(product)
+        self._see(product)
 
     def get(self, sku: str) -> model.Product:
         product = self._get(sku)
         if product:
-            self.seen.add(product)
+            self._see(product)
         return product
 
+    def get_many(self, skus: Iterable[str]) -> Dict[str, model.Product]:
+        """The products found for the given skus, by sku."""
+        products = self._get_many(list(dict.fromkeys(skus)))
+        for product in products.values():
+            self._see(product)
+        return products
+
+    def _see(self, product: model.Product) -> None:
+        self.seen.add(product)
+        self.outbox.track(product)
+
     @abstractmethod
     def _add(self, product: model.Product) -> None:
         raise NotImplementedError
@@ -25,14 +120,233 @@ class AbstractRepository(ABC):
     def _get(self, sku: str) -> model.Product:
         raise NotImplementedError
 
+    def _get_many(self, skus: List[str]) -> Dict[str, model.Product]:
+        products = ((sku, self._get(sku)) for sku in skus)
+        return {sku: product for sku, product in products if product}
+
+
+class ProductCache:
+    """
+    Detached, fully loaded products kept between units of work, least
+    recently used first out. A product is taken out of the cache while a
+    unit of work uses it, and only goes back once that unit of work has
+    committed, so two units of work never share an instance.
+    """
+
+    def __init__(self, max_size: int = 128) -> None:
+        self.max_size = max_size
+        self._products = OrderedDict()  # type: OrderedDict[str, model.Product]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    def checkout(self, sku: str) -> Optional[model.Product]:
+        with self._lock:
+            return self._products.pop(sku, None)
+
+    def put(self, products: Iterable[model.Product]) -> None:
+        with self._lock:
+            for product in products:
+                self._products[product.sku] = product
+                self._products.move_to_end(product.sku)
+            while len(self._products) > self.max_size:
+                self._products.popitem(last=False)
+
+    def invalidate(self, sku: str) -> None:
+        with self._lock:
+            self._products.pop(sku, None)
+
+
+# SELECT ... FOR UPDATE flavours a repository can lock products rows with;
+# with skip_locked a product someone else has locked raises ProductLocked
+LOCK_MODES = {
+    "update": {},
+    "nowait": {"nowait": True},
+    "skip_locked": {"skip_locked": True},
+}
+
+
+class ProductLocked(Exception):
+    """A product that exists, but that another transaction has locked."""
+
 
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session):
+    # skus per IN query when fetching many products
+    FETCH_CHUNK_SIZE = 1000
+
+    def __init__(
+        self,
+        session,
+        loading_strategy: Optional[str] = None,
+        cache: Optional[ProductCache] = None,
+        lock_mode: Optional[str] = None,
+        reuse_loaded: bool = False,
+    ):
         super().__init__()
         self.session = session
+        # overrides the strategy the mappers were started with
+        self.loading_strategy = loading_strategy
+        self.cache = cache
+        if lock_mode is not None and lock_mode not in LOCK_MODES:
+            raise ValueError(f"Unknown lock mode {lock_mode}")
+        self.lock_mode = lock_mode
+        # hand back products already in the session without a query; they
+        # still get refreshed if they've been expired since
+        self.reuse_loaded = reuse_loaded
 
     def _add(self, product: model.Product) -> None:
         self.session.add(product)
 
     def _get(self, sku: str) -> model.Product:
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        # a lock has to be taken again in every transaction
+        if self.reuse_loaded and self.lock_mode is None:
+            key = self.session.identity_key(model.Product, sku)
+            product = self.session.identity_map.get(key)
+            if product is not None:
+                return product
+        if self.cache is not None:
+            product = self._get_cached(sku)
+            if product is not None:
+                return product
+        product = self._query().filter_by(sku=sku).first()
+        if product is None:
+            self._check_not_skipped([sku])
+        return product
+
+    def _get_many(self, skus: List[str]) -> Dict[str, model.Product]:
+        products = {}  # type: Dict[str, model.Product]
+        if self.cache is not None:
+            products.update(self._get_many_cached(skus))
+        missing = [sku for sku in skus if sku not in products]
+        for i in range(0, len(missing), self.FETCH_CHUNK_SIZE):
+            chunk = missing[i : i + self.FETCH_CHUNK_SIZE]
+            query = self._query().filter(model.Product.sku.in_(chunk))
+            products.update((product.sku, product) for product in query)
+        self._check_not_skipped([sku for sku in skus if sku not in products])
+        return products
+
+    def _query(self):
+        query = self.session.query(model.Product)
+        if self.loading_strategy is not None:
+            query = query.options(
+                orm.load_product_graph(self.loading_strategy)
+            )
+        if self.lock_mode is not None:
+            # only the products rows: batches are only changed through them
+            query = query.with_for_update(
+                of=model.Product, **LOCK_MODES[self.lock_mode]
+            )
+        return query
+
+    def _check_not_skipped(self, skus: List[str]) -> None:
+        # SKIP LOCKED leaves out locked rows as if they didn't exist, which
+        # for a lookup by sku would read as an unknown product
+        if self.lock_mode != "skip_locked" or not skus:
+            return
+        query = select(orm.products.c.sku).where(orm.products.c.sku.in_(skus))
+        locked = self.session.execute(query).scalars().all()
+        if locked:
+            raise ProductLocked(f"Products locked elsewhere: {locked}")
+
+    def _versions(self, skus: List[str]):
+        query = select(
+            orm.products.c.sku, orm.products.c.version_number
+        ).where(orm.products.c.sku.in_(skus))
+        if self.lock_mode is not None:
+            query = query.with_for_update(**LOCK_MODES[self.lock_mode])
+        return dict(self.session.execute(query).all())
+
+    def _get_cached(self, sku: str) -> Optional[model.Product]:
+        product = self.cache.checkout(sku)
+        if product is None:
+            return None
+        # every change to a product bumps its version, so a matching version
+        # means nobody has changed it since it was cached
+        version = self._versions([sku]).get(sku)
+        if version != product.version_number:
+            return None
+        self.session.add(product)
+        return product
+
+    def _get_many_cached(self, skus: List[str]) -> Dict[str, model.Product]:
+        cached = {}  # type: Dict[str, model.Product]
+        for sku in skus:
+            product = self.cache.checkout(sku)
+            if product is not None:
+                cached[sku] = product
+        if not cached:
+            return {}
+        versions = self._versions(list(cached))
+        products = {
+            sku: product
+            for sku, product in cached.items()
+            if versions.get(sku) == product.version_number
+        }
+        self.session.add_all(products.values())
+        return products
+
+
+class ShardedSqlAlchemyRepository(AbstractRepository):
+    """
+    Products spread over several databases by sku, each read and written
+    through the repository of the shard its sku lives on.
+    """
+
+    def __init__(
+        self, repository_for: Callable[[str], SqlAlchemyRepository]
+    ) -> None:
+        super().__init__()
+        self.repository_for = repository_for
+
+    def _add(self, product: model.Product) -> None:
+        self.repository_for(product.sku)._add(product)
+
+    def _get(self, sku: str) -> model.Product:
+        return self.repository_for(sku)._get(sku)
+
+    def _get_many(self, skus: List[str]) -> Dict[str, model.Product]:
+        shards = defaultdict(list)  # type: Dict[AbstractRepository, List]
+        for sku in skus:
+            shards[self.repository_for(sku)].append(sku)
+        products = {}  # type: Dict[str, model.Product]
+        for shard, shard_skus in shards.items():
+            products.update(shard._get_many(shard_skus))
+        return products
+
+
+class AsyncSqlAlchemyRepository:
+    """
+    A SqlAlchemyRepository over an AsyncSession, whose queries run in the
+    session's greenlet. Products come back with their batches already
+    loaded, since nothing can be lazy loaded from them outside it; code
+    that allocates to them, and so looks up lines, has to run through the
+    unit of work's run_sync().
+    """
+
+    def __init__(self, session, lock_mode: Optional[str] = None):
+        self.session = session
+        self._repository = SqlAlchemyRepository(
+            session.sync_session, "selectin", lock_mode=lock_mode
+        )
+
+    @property
+    def seen(self) -> Set[model.Product]:
+        return self._repository.seen
+
+    @property
+    def outbox(self) -> Outbox:
+        return self._repository.outbox
+
+    def add(self, product: model.Product) -> None:
+        self._repository.add(product)
+
+    async def get(self, sku: str) -> model.Product:
+        return await self.session.run_sync(lambda _: self._repository.get(sku))
+
+    async def get_many(self, skus: Iterable[str]) -> Dict[str, model.Product]:
+        """The products found for the given skus, by sku."""
+        skus = list(skus)
+        return await self.session.run_sync(
+            lambda _: self._repository.get_many(skus)
+        )
@@ -0,0 +1,83 @@
+from sqlalchemy import Index, func, inspect, select, text
+from allocation.adapters import orm
+
+
+class DuplicateRows(Exception):
+    """Rows that a unique index about to be created would reject."""
+
+
+def upgrade(engine) -> None:
+    """
+    Bring a database created by an earlier version up to the schema in
+    orm.metadata: missing tables, the batches._allocated_quantity column
+    and missing indexes. It all happens in one transaction, so a database
+    it fails on is left as it was, and running it again changes nothing.
+    """
+    with engine.begin() as connection:
+        # creates missing tables along with their indexes, leaves the rest be
+        orm.metadata.create_all(connection)
+        inspector = inspect(connection)
+        existing = {
+            table.name: {i["name"] for i in inspector.get_indexes(table.name)}
+            for table in orm.metadata.sorted_tables
+        }
+
+        # a line allocated to a batch more than once is the same allocation
+        # repeated, so all but one of them can go
+        removed = 0
+        if (
+            "ux_allocations_batch_id_order_line_id"
+            not in existing["allocations"]
+        ):
+            removed = remove_repeated_allocations(connection)
+
+        columns = {c["name"] for c in inspector.get_columns("batches")}
+        if "_allocated_quantity" not in columns:
+            connection.execute(
+                text(
+                    "ALTER TABLE batches ADD COLUMN"
+                    " _allocated_quantity INTEGER NOT NULL DEFAULT 0"
+                )
+            )
+            orm.reconcile_allocated_quantities(connection)
+        elif removed:
+            orm.reconcile_allocated_quantities(connection)
+
+        for table in orm.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in existing[table.name]:
+                    continue
+                if index.unique:
+                    check_unique(connection, index)
+                index.create(connection)
+
+
+def remove_repeated_allocations(connection) -> int:
+    """Delete all but the first of each batch's allocations of a line."""
+    allocations = orm.allocations
+    first = select(func.min(allocations.c.id)).group_by(
+        allocations.c.batch_id, allocations.c.order_line_id
+    )
+    result = connection.execute(
+        allocations.delete().where(allocations.c.id.not_in(first))
+    )
+    return result.rowcount
+
+
+def check_unique(connection, index: Index, shown: int = 10) -> None:
+    columns = list(index.columns)
+    query = (
+        select(*columns)
+        .group_by(*columns)
+        .having(func.count() > 1)
+        .limit(shown)
+    )
+    duplicates = connection.execute(query).all()
+    if duplicates:
+        names = ", ".join(c.name for c in columns)
+        raise DuplicateRows(
+            f"Can't create {index.name}: {index.table.name} has more than"
+            f" one row for ({names}) in {[tuple(d) for d in duplicates]}"
+            f"{' and more' if len(duplicates) == shown else ''}; they have"
+            " to be resolved before upgrading"
+        )
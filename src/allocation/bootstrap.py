@@ -1,34 +1,54 @@
+import asyncio
+from concurrent.futures import Executor
 import inspect
-from typing import Callable, Iterable
+from typing import Callable, Dict, Iterable, List, Optional, Type
 from allocation.adapters.notifications import (
     EmailNotifications,
     AbstractNotifications,
 )
 
-from allocation.service_layer import message_bus
+from allocation.service_layer import async_handlers, message_bus
+from allocation.service_layer.projector import ReadModelProjector
 from allocation.service_layer.unit_of_work import (
+    AbstractAsyncUnitOfWork,
     AbstractUnitOfWork,
-    SqlAlchemyUnitOfWork,
+    ThreadLocalUnitOfWork,
+    default_async_unit_of_work,
+    default_unit_of_work,
+)
+from allocation.adapters.redis_event_publisher import (
+    publish_message,
+    publish_message_async,
 )
-from allocation.adapters.redis_event_publisher import publish_message
 from allocation.adapters import orm
+from allocation.domain import events, model
 from allocation.entrypoints.flask_utils import get_message_queue
 from allocation.service_layer.handlers import (
     EVENT_HANDLERS,
     COMMAND_HANDLERS,
+    READ_MODEL_HANDLERS,
 )
 
 
 def bootstrap(
     start_orm: bool = True,
-    uow: AbstractUnitOfWork = SqlAlchemyUnitOfWork(),
+    uow: Optional[AbstractUnitOfWork] = None,
     message_queue_factory: Callable = get_message_queue,
     publish: Callable = publish_message,
     notifications: AbstractNotifications = None,
+    deallocation_policy: model.DeallocationPolicy = model.fewest_lines,
+    retry_policy: message_bus.RetryPolicy = message_bus.RetryPolicy(),
+    read_uow: Optional[AbstractUnitOfWork] = None,
+    projector: Optional[ReadModelProjector] = None,
+    executor: Optional[Executor] = None,
 ) -> message_bus.MessageBus:
     if start_orm:
         orm.start_mappers()
 
+    if uow is None:
+        # a unit of work per thread, so the bus can serve several at once
+        uow = ThreadLocalUnitOfWork(default_unit_of_work)
+
     if notifications is None:
         notifications = EmailNotifications()
 
@@ -36,13 +56,16 @@ def bootstrap(
         "uow": uow,
         "publish": publish,
         "notifications": notifications,
+        "deallocation_policy": deallocation_policy,
     }
-    injected_event_handlers = {
-        event_type: [
-            inject_dependencies(handler, dependencies) for handler in handlers
-        ]
-        for event_type, handlers in EVENT_HANDLERS.items()
-    }
+
+    injected_event_handlers = inject_event_handlers(
+        EVENT_HANDLERS,
+        READ_MODEL_HANDLERS,
+        dependencies,
+        uow,
+        projector.handle if projector else None,
+    )
 
     injected_command_handlers = {
         command_type: inject_dependencies(handler, dependencies)
@@ -54,9 +77,97 @@ def bootstrap(
         message_queue_factory,
         injected_event_handlers,
         injected_command_handlers,
+        retry_policy,
+        read_uow,
+        after_handle=[projector.flush_if_due] if projector else [],
+        executor=executor,
+    )
+
+
+def bootstrap_async(
+    start_orm: bool = True,
+    uow: Optional[AbstractAsyncUnitOfWork] = None,
+    publish: Callable = publish_message_async,
+    notifications: AbstractNotifications = None,
+    deallocation_policy: model.DeallocationPolicy = model.fewest_lines,
+    retry_policy: message_bus.RetryPolicy = message_bus.RetryPolicy(),
+    projector: Optional[ReadModelProjector] = None,
+) -> message_bus.AsyncMessageBus:
+    if start_orm:
+        orm.start_mappers()
+
+    if uow is None:
+        uow = default_async_unit_of_work()
+
+    if notifications is None:
+        notifications = EmailNotifications()
+
+    dependencies = {
+        "uow": uow,
+        "publish": publish,
+        "notifications": notifications,
+        "deallocation_policy": deallocation_policy,
+    }
+    injected_event_handlers = inject_event_handlers(
+        async_handlers.EVENT_HANDLERS,
+        async_handlers.READ_MODEL_HANDLERS,
+        dependencies,
+        uow,
+        project_async(projector) if projector else None,
+    )
+    injected_command_handlers = {
+        command_type: inject_dependencies(handler, dependencies)
+        for command_type, handler in async_handlers.COMMAND_HANDLERS.items()
+    }
+
+    return message_bus.AsyncMessageBus(
+        uow,
+        injected_event_handlers,
+        injected_command_handlers,
+        retry_policy,
     )
 
 
+def inject_event_handlers(
+    event_handlers: Dict[Type[events.Event], List[Callable]],
+    read_model_handlers: List[Callable],
+    dependencies: Dict,
+    uow,
+    project: Optional[Callable],
+) -> Dict[Type[events.Event], List[Callable]]:
+    def event_handler(handler: Callable) -> Optional[Callable]:
+        if handler in read_model_handlers:
+            # units of work that write the read model as they commit leave
+            # nothing for its handlers to do
+            if getattr(uow, "project_read_model", False):
+                return None
+            if project is not None:
+                return project
+        return inject_dependencies(handler, dependencies)
+
+    return {
+        event_type: [
+            injected
+            for injected in map(event_handler, handlers)
+            if injected is not None
+        ]
+        for event_type, handlers in event_handlers.items()
+    }
+
+
+def project_async(projector: ReadModelProjector) -> Callable:
+    async def project(event):
+        # a full buffer is flushed there and then, which blocks
+        await asyncio.get_running_loop().run_in_executor(
+            None, projector.handle, event
+        )
+
+    # awaited in turn like the handlers using the unit of work, so the
+    # events are buffered in the order they came up
+    project.uses_uow = True
+    return project
+
+
 def inject_dependencies(handler: Callable, dependencies) -> Callable:
     params = inspect.signature(handler).parameters
     deps = {
@@ -65,7 +176,15 @@ def inject_dependencies(handler: Callable, dependencies) -> Callable:
         if name in params
     }
 
-    def injected_handler(message, deps=deps):
-        return handler(message, **deps)
+    if inspect.iscoroutinefunction(handler):
+
+        async def injected_handler(message, deps=deps):
+            return await handler(message, **deps)
+
+    else:
+
+        def injected_handler(message, deps=deps):
+            return handler(message, **deps)
 
+    injected_handler.uses_uow = "uow" in deps
     return injected_handler
@@ -1,5 +1,5 @@
 import os
-from typing import Dict
+from typing import Dict, List, Optional
 
 
 def get_postgres_uri() -> str:
@@ -10,6 +10,54 @@ def get_postgres_uri() -> str:
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_async_postgres_uri() -> str:
+    # the same database, through asyncpg
+    return get_postgres_uri().replace("postgresql://", "postgresql+asyncpg://")
+
+
+def get_shard_uris() -> List[str]:
+    # comma separated databases to spread products over by sku, in a fixed
+    # order: adding or reordering shards moves skus between them. Unset
+    # keeps every product in the database at get_postgres_uri()
+    uris = os.environ.get("DB_SHARD_URIS", "")
+    return [uri.strip() for uri in uris.split(",") if uri.strip()]
+
+
+def get_replica_uris() -> List[str]:
+    # comma separated read replicas for views, one per shard in the shards'
+    # order; unset reads from the primaries
+    uris = os.environ.get("DB_REPLICA_URIS", "")
+    replicas = [uri.strip() for uri in uris.split(",") if uri.strip()]
+    primaries = get_shard_uris() or [get_postgres_uri()]
+    # replicas are matched to shards by position, so any fewer or more would
+    # send some skus' reads to the wrong database
+    if replicas and len(replicas) != len(primaries):
+        raise ValueError(
+            f"DB_REPLICA_URIS has {len(replicas)} databases for"
+            f" {len(primaries)} shards; it needs one per shard"
+        )
+    return replicas or primaries
+
+
+def get_read_isolation_level() -> str:
+    # views only run single SELECTs, which need no transaction around them
+    return os.environ.get("DB_READ_ISOLATION_LEVEL", "AUTOCOMMIT")
+
+
+def get_lock_mode() -> Optional[str]:
+    # "update", "nowait" or "skip_locked" to lock products as they're read,
+    # unset to rely on product versions alone; the last two make commands
+    # on a locked product retry rather than wait
+    return os.environ.get("DB_LOCK_MODE") or None
+
+
+def get_isolation_level() -> str:
+    # product versions catch conflicting writes, so READ COMMITTED is safe;
+    # with products locked as they're read it's all that's needed
+    default = "READ COMMITTED" if get_lock_mode() else "REPEATABLE READ"
+    return os.environ.get("DB_ISOLATION_LEVEL", default)
+
+
 def get_api_url() -> str:
     host = os.environ.get("API_HOST", "localhost")
     port = 5000
@@ -29,5 +77,41 @@ def get_email_host_and_port() -> Dict:
     return dict(host=host, port=port, http_port=http_port)
 
 
+def get_product_cache_size() -> int:
+    # products kept between units of work by each process, 0 turns it off
+    return int(os.environ.get("PRODUCT_CACHE_SIZE", 0))
+
+
+def get_scoped_sessions() -> bool:
+    # share one session between the handlers of each message the bus handles
+    return os.environ.get("SCOPED_SESSIONS", "0") == "1"
+
+
+def get_read_model_in_transaction() -> bool:
+    # write the read model in the same transaction as the products it shows
+    return os.environ.get("READ_MODEL_IN_TRANSACTION", "0") == "1"
+
+
+def get_read_model_batch_size() -> int:
+    # events the read model projector buffers before writing them out, 0
+    # writes each one as it comes
+    return int(os.environ.get("READ_MODEL_BATCH_SIZE", 0))
+
+
+def get_read_model_max_delay() -> float:
+    # seconds an event may wait in the projector's buffer
+    return float(os.environ.get("READ_MODEL_MAX_DELAY", 0.5))
+
+
+def get_event_handler_threads() -> int:
+    # threads running event handlers that don't use the unit of work
+    return int(os.environ.get("EVENT_HANDLER_THREADS", 0))
+
+
+def get_max_concurrent_messages() -> int:
+    # messages the asyncio consumer handles at once
+    return int(os.environ.get("MAX_CONCURRENT_MESSAGES", 100))
+
+
 def get_dev_db_uri():
     return "sqlite:///dev_data.sqlite"
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional, Tuple
 from datetime import date
 
 
@@ -22,6 +22,12 @@ class Allocate(Command):
     qty: int
 
 
+@dataclass
+class AllocateMany(Command):
+    sku: str
+    lines: List[Tuple[str, int]]  # (order_id, qty) pairs
+
+
 @dataclass
 class ChangeBatchQuantity(Command):
     reference: str
@@ -1,6 +1,9 @@
+import sys
+from bisect import bisect_left, insort
 from dataclasses import dataclass
 from datetime import date
-from typing import List, Optional
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+import numpy as np
 from allocation.domain import commands, events
 
 
@@ -8,12 +11,26 @@ class OutOfStock(Exception):
     pass
 
 
+class DuplicateBatch(Exception):
+    pass
+
+
+class UnknownBatch(Exception):
+    pass
+
+
 @dataclass(unsafe_hash=True)
 class OrderLine:
     order_id: str
     sku: str
     qty: int
 
+    def __post_init__(self):
+        # every line and batch of a product repeats the same few strings,
+        # so keep a single copy of each
+        self.order_id = sys.intern(self.order_id)
+        self.sku = sys.intern(self.sku)
+
 
 class Batch:
     def __init__(
@@ -24,10 +41,13 @@ class Batch:
         eta: Optional[date],
     ) -> None:
         self.reference = ref
-        self.sku = sku
+        self.sku = sys.intern(sku)
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: set[OrderLine]
+        # running total of the allocated lines, so capacity checks don't
+        # have to sum over every allocation
+        self._allocated_quantity = 0
 
     def __eq__(self, other):
         if not isinstance(other, Batch):
@@ -45,25 +65,222 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine) -> None:
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
             self._allocations.add(line)
+            self._allocated_quantity += line.qty
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        line = self._allocations.pop()
+        self._allocated_quantity -= line.qty
+        return line
+
+    def deallocate(self, lines: Iterable[OrderLine]) -> None:
+        for line in lines:
+            self._allocations.remove(line)
+            self._allocated_quantity -= line.qty
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
         return self._purchased_quantity - self.allocated_quantity
 
 
+DeallocationPolicy = Callable[[Iterable[OrderLine], int], List[OrderLine]]
+
+
+def fewest_lines(
+    lines: Iterable[OrderLine], shortfall: int
+) -> List[OrderLine]:
+    """Release the biggest lines first, so as few orders as possible move."""
+    released, freed = [], 0
+    for line in sorted(lines, key=lambda line: line.qty, reverse=True):
+        if freed >= shortfall:
+            break
+        released.append(line)
+        freed += line.qty
+    return released
+
+
+def any_lines(lines: Iterable[OrderLine], shortfall: int) -> List[OrderLine]:
+    """Release lines in the order the batch holds them, without sorting."""
+    released, freed = [], 0
+    for line in lines:
+        if freed >= shortfall:
+            break
+        released.append(line)
+        freed += line.qty
+    return released
+
+
+class BatchOrder:
+    """
+    The batches of a product in allocation order: warehouse stock first,
+    then by ETA, ties kept in the order the batches were added. Batches with
+    nothing left to allocate are also kept out of a separate "open" view,
+    so allocating doesn't have to step over exhausted batches.
+    """
+
+    def __init__(self, batches: Iterable[Batch] = ()) -> None:
+        self._added = 0
+        self._keys = {}  # type: Dict[Batch, Tuple]
+        self._all = []  # type: List[Tuple]
+        self._open = []  # type: List[Tuple]
+        for batch in batches:
+            self.add(batch)
+
+    def __len__(self) -> int:
+        return len(self._all)
+
+    def __iter__(self):
+        return (entry[-1] for entry in self._all)
+
+    def add(self, batch: Batch) -> None:
+        # the running counter breaks ETA ties the way a stable sort would,
+        # and keeps keys unique so a batch can always be found by bisecting
+        key = (batch.eta is not None, batch.eta or date.min, self._added)
+        self._added += 1
+        self._keys[batch] = key
+        insort(self._all, (*key, batch))
+        self.refresh(batch)
+
+    def refresh(self, batch: Batch) -> None:
+        """Re-check whether a batch whose quantities changed is open."""
+        entry = (*self._keys[batch], batch)
+        i = bisect_left(self._open, entry)
+        is_listed = i < len(self._open) and self._open[i][-1] is batch
+        if batch.available_quantity > 0 and not is_listed:
+            self._open.insert(i, entry)
+        elif batch.available_quantity <= 0 and is_listed:
+            del self._open[i]
+
+    def candidates(self, line: OrderLine) -> Iterable[Batch]:
+        # an exhausted batch can still take an empty line
+        if line.qty > 0:
+            return (entry[-1] for entry in self._open)
+        return iter(self)
+
+    def first_fit(self, line: OrderLine) -> Optional[Batch]:
+        return next(
+            (b for b in self.candidates(line) if b.can_allocate(line)), None
+        )
+
+
+class BatchColumns:
+    """
+    The same allocation order as BatchOrder, with each batch's ETA,
+    purchased and allocated quantities held in parallel NumPy columns, so
+    finding the first batch a line fits in is one vectorized scan instead of
+    a Python loop over batch objects. The batch objects are still updated
+    alongside the columns, as they are what gets persisted.
+    """
+
+    def __init__(self, batches: Iterable[Batch] = ()) -> None:
+        batches = list(batches)
+        etas = np.array([self._eta_key(b) for b in batches], dtype=np.int64)
+        # a stable sort keeps batches with the same ETA in the order given
+        order = np.argsort(etas, kind="stable")
+        self._batches = [batches[i] for i in order]
+        self._eta = etas[order]
+        self._purchased = np.array(
+            [b._purchased_quantity for b in self._batches], dtype=np.int64
+        )
+        self._allocated = np.array(
+            [b.allocated_quantity for b in self._batches], dtype=np.int64
+        )
+        self._skus = np.array([b.sku for b in self._batches], dtype=object)
+        self._reindex()
+
+    @staticmethod
+    def _eta_key(batch: Batch) -> int:
+        # warehouse stock sorts ahead of any real date's ordinal
+        return batch.eta.toordinal() if batch.eta is not None else 0
+
+    def _reindex(self) -> None:
+        self._positions = {b: i for i, b in enumerate(self._batches)}
+        self._distinct_skus = set(self._skus)
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def __iter__(self):
+        return iter(self._batches)
+
+    def add(self, batch: Batch) -> None:
+        key = self._eta_key(batch)
+        i = int(np.searchsorted(self._eta, key, side="right"))
+        self._batches.insert(i, batch)
+        self._eta = np.insert(self._eta, i, key)
+        self._purchased = np.insert(
+            self._purchased, i, batch._purchased_quantity
+        )
+        self._allocated = np.insert(
+            self._allocated, i, batch.allocated_quantity
+        )
+        self._skus = np.insert(self._skus, i, batch.sku)
+        self._reindex()
+
+    def refresh(self, batch: Batch) -> None:
+        i = self._positions[batch]
+        self._purchased[i] = batch._purchased_quantity
+        self._allocated[i] = batch.allocated_quantity
+
+    def first_fit(self, line: OrderLine) -> Optional[Batch]:
+        if line.sku not in self._distinct_skus:
+            return None
+        fits = self._purchased - self._allocated >= line.qty
+        if len(self._distinct_skus) > 1:
+            fits &= self._skus == line.sku
+        i = int(fits.argmax())
+        return self._batches[i] if fits[i] else None
+
+
+AllocationOrder = Union[BatchOrder, BatchColumns]
+
+
+def allocation_run(
+    remaining: np.ndarray,
+    fits: np.ndarray,
+    qtys: np.ndarray,
+    start: int,
+    window: int,
+    bulk: Optional[np.ndarray] = None,
+) -> Optional[Tuple[int, int]]:
+    """
+    The batch, by position in allocation order, that the line at `start`
+    goes to, given which batches it `fits`, and the end of the run of lines
+    that go there with it; None if it fits none. Only lines that `bulk`
+    allows, where given, can join the run.
+    """
+    if not fits.any():
+        return None
+    i = int(fits.argmax())
+    if bulk is not None and not bulk[start]:
+        return i, start + 1
+
+    # the lines that follow go to the same batch for as long as none of the
+    # batches ahead of it can take them, and it still has room for all of
+    # them
+    run = slice(start, start + window)
+    ceiling = remaining[:i].max() if i else np.iinfo(np.int64).min
+    breaks = (qtys[run] <= ceiling) | (np.cumsum(qtys[run]) > remaining[i])
+    if bulk is not None:
+        breaks |= ~bulk[run]
+    return i, start + (int(breaks.argmax()) if breaks.any() else len(breaks))
+
+
 class Product:
+    # how many lines allocate_many() looks ahead when sending a run of lines
+    # to the same batch
+    BULK_WINDOW = 1024
+    # products with at least this many batches allocate from BatchColumns
+    COLUMNAR_THRESHOLD = 1000
+
     def __init__(
         self, sku: str, batches: List[Batch], version_number: int = 0
     ) -> None:
@@ -71,32 +288,155 @@ class Product:
         self.batches = batches
         self.version_number = version_number
         self.events = []  # type: List[events.Event]
+        self.invalidate_indexes()
 
-    def allocate(self, line: OrderLine) -> str:
-        try:
-            batch: Batch = next(
-                b for b in sorted(self.batches) if b.can_allocate(line)
-            )
-            batch.allocate(line)
-            self.version_number += 1
-            self.events.append(
-                events.Allocated(
-                    line.order_id, line.sku, line.qty, batch.reference
-                )
+    def invalidate_indexes(self) -> None:
+        """
+        Forget the allocation order and the lookup by reference, e.g. once
+        the batches have been loaded or refreshed from the database.
+        """
+        self._batch_order = None  # type: Optional[AllocationOrder]
+        self._batch_lookup = None  # type: Optional[Dict[str, Batch]]
+        # the batches list the indexes were built from, and its length
+        self._indexed = None  # type: Optional[List[Batch]]
+        self._indexed_count = 0
+
+    def _check_indexes(self) -> None:
+        # a batches list replaced wholesale, or appended to directly, leaves
+        # both indexes behind
+        if self._indexed is not self.batches or self._indexed_count != len(
+            self.batches
+        ):
+            self.invalidate_indexes()
+            self._indexed = self.batches
+            self._indexed_count = len(self.batches)
+
+    def _allocation_order(self) -> AllocationOrder:
+        # built on first use, and rebuilt once the product has grown enough
+        # to switch to columns
+        self._check_indexes()
+        kind = (
+            BatchColumns
+            if len(self.batches) >= self.COLUMNAR_THRESHOLD
+            else BatchOrder
+        )
+        if not isinstance(self._batch_order, kind):
+            self._batch_order = kind(self.batches)
+        return self._batch_order
+
+    def _batches_by_reference(self) -> Dict[str, Batch]:
+        self._check_indexes()
+        if self._batch_lookup is None:
+            self._batch_lookup = {b.reference: b for b in self.batches}
+        return self._batch_lookup
+
+    def add_batch(self, batch: Batch) -> None:
+        lookup = self._batches_by_reference()
+        if batch.reference in lookup:
+            raise DuplicateBatch(
+                f"Duplicate batch reference {batch.reference}"
             )
-            return batch.reference
-        except StopIteration:
+        order = self._allocation_order()
+        self.batches.append(batch)
+        self._indexed_count += 1
+        lookup[batch.reference] = batch
+        order.add(batch)
+        self.version_number += 1
+
+    def allocate(self, line: OrderLine) -> str:
+        order = self._allocation_order()
+        batch = order.first_fit(line)
+        if batch is not None and not batch.can_allocate(line):
+            # the order's copy of the quantities has gone stale; go by the
+            # batches themselves
+            self.invalidate_indexes()
+            order = self._allocation_order()
+            batch = order.first_fit(line)
+        if batch is None:
             self.events.append(events.OutOfStock(line.sku))
             # raise OutOfStock(f"Out of stock for sku {line.sku}")
             return None
+        batch.allocate(line)
+        order.refresh(batch)
+        self.version_number += 1
+        self.events.append(
+            events.Allocated(
+                line.order_id, line.sku, line.qty, batch.reference
+            )
+        )
+        return batch.reference
 
-    def change_batch_quantity(self, reference: str, sku: str, qty: int):
-        batch: Batch = next(
-            b for b in self.batches if b.reference == reference
+    def allocate_many(self, lines: Iterable[OrderLine]) -> List[Optional[str]]:
+        """
+        Allocate lines in one pass, with the same batch choices and events as
+        calling allocate() for each line in turn.
+        """
+        lines = list(lines)
+        order = self._allocation_order()
+        batches = list(order)
+        remaining = np.array(
+            [b.available_quantity for b in batches], dtype=np.int64
         )
+        qtys = np.array([line.qty for line in lines], dtype=np.int64)
+        # a run of lines can only be sent to one batch in bulk if no sku
+        # check along the way could send one of them elsewhere
+        if all(b.sku == self.sku for b in batches):
+            bulk = np.array([line.sku == self.sku for line in lines])
+        else:
+            bulk = np.zeros(len(lines), dtype=bool)
+        sku_matches = {}  # type: Dict[str, np.ndarray]
+        references = []  # type: List[Optional[str]]
+        start = 0
+        while start < len(lines):
+            line = lines[start]
+            if line.sku not in sku_matches:
+                sku_matches[line.sku] = np.array(
+                    [b.sku == line.sku for b in batches], dtype=bool
+                )
+            fits = (remaining >= line.qty) & sku_matches[line.sku]
+            run = allocation_run(
+                remaining, fits, qtys, start, self.BULK_WINDOW, bulk
+            )
+            if run is None:
+                self.events.append(events.OutOfStock(line.sku))
+                references.append(None)
+                start += 1
+                continue
+            i, end = run
+
+            batch = batches[i]
+            for line in lines[start:end]:
+                batch.allocate(line)
+                self.version_number += 1
+                self.events.append(
+                    events.Allocated(
+                        line.order_id, line.sku, line.qty, batch.reference
+                    )
+                )
+                references.append(batch.reference)
+            remaining[i] = batch.available_quantity
+            order.refresh(batch)
+            start = end
+        return references
+
+    def change_batch_quantity(
+        self,
+        reference: str,
+        sku: str,
+        qty: int,
+        policy: DeallocationPolicy = fewest_lines,
+    ):
+        batch = self._batches_by_reference().get(reference)
+        if batch is None:
+            raise UnknownBatch(f"Unknown batch reference {reference}")
         batch._purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(
+        shortfall = -batch.available_quantity
+        if shortfall > 0:
+            released = policy(batch._allocations, shortfall)
+            batch.deallocate(released)
+            self.events.extend(
                 events.Deallocated(line.order_id, line.sku, line.qty)
+                for line in released
             )
+        self._allocation_order().refresh(batch)
+        self.version_number += 1
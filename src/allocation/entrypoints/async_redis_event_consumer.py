@@ -0,0 +1,103 @@
+import asyncio
+from collections import Counter
+from contextlib import asynccontextmanager
+import json
+import logging
+import redis.asyncio
+from typing import AsyncIterable, AsyncIterator, Dict, Callable, Set
+from allocation import config
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.service_layer import message_bus, projector
+
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    logger.info("Redis pubsub starting")
+    bus = bootstrap.bootstrap_async(projector=projector.from_config())
+    r = redis.asyncio.Redis(**config.get_redis_host_and_port())
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(*CHANNELS)
+    await consume(pubsub.listen(), bus)
+
+
+async def consume(messages: AsyncIterable, bus: message_bus.AsyncMessageBus):
+    # each message is handled in a task of its own, so that those waiting
+    # on the database or Redis don't hold up the rest, but only one at a
+    # time for each sku, so theirs are applied in the order they came
+    in_progress = asyncio.Semaphore(config.get_max_concurrent_messages())
+    locks = SkuLocks()
+    tasks = set()  # type: Set[asyncio.Task]
+    async for msg in messages:
+        await in_progress.acquire()
+        task = asyncio.ensure_future(handle(msg, bus, locks))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(lambda _: in_progress.release())
+    await asyncio.gather(*tasks)
+
+
+class SkuLocks:
+    """
+    An asyncio.Lock for each sku with messages in progress. Waiters get
+    the lock in the order they asked for it, so as long as each message's
+    task asks before it first awaits anything, messages for a sku are
+    handled in the order they arrived.
+    """
+
+    def __init__(self) -> None:
+        self._locks = {}  # type: Dict[str, asyncio.Lock]
+        self._holders = Counter()  # type: Dict[str, int]
+
+    @asynccontextmanager
+    async def hold(self, sku: str) -> AsyncIterator[None]:
+        lock = self._locks.setdefault(sku, asyncio.Lock())
+        self._holders[sku] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            # forget skus nobody is waiting on, or there'd be a lock for
+            # every sku ever seen
+            self._holders[sku] -= 1
+            if not self._holders[sku]:
+                del self._holders[sku]
+                del self._locks[sku]
+
+
+async def handle(msg, bus: message_bus.AsyncMessageBus, locks: SkuLocks):
+    try:
+        channel = str(msg["channel"], "utf-8")
+        handler = HANDLERS[channel]
+        async with locks.hold(json.loads(msg["data"])["sku"]):
+            await handler(msg, bus)
+    except Exception:
+        # nothing awaits the task, so this is the only place to see it
+        logger.exception(f"Exception handling {msg}")
+
+
+async def handle_change_batch_quantity(msg, bus: message_bus.AsyncMessageBus):
+    logging.debug(f"handling {msg}")
+    data = json.loads(msg["data"])
+    cmd = commands.ChangeBatchQuantity(
+        data["reference"], data["sku"], data["qty"]
+    )
+    await bus.handle(cmd)
+
+
+async def handle_allocate(msg, bus: message_bus.AsyncMessageBus):
+    logging.debug(f"handling {msg}")
+    data = json.loads(msg["data"])
+    cmd = commands.Allocate(data["order_id"], data["sku"], data["qty"])
+    await bus.handle(cmd)
+
+
+HANDLERS = {
+    "change_batch_quantity": handle_change_batch_quantity,
+    "allocate": handle_allocate,
+}  # type: Dict[str, Callable]
+
+CHANNELS = list(HANDLERS.keys())
+if __name__ == "__main__":
+    asyncio.run(main())
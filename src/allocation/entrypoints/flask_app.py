@@ -1,14 +1,26 @@
 from datetime import datetime
 from flask import request, jsonify
 from allocation import views, bootstrap
-from allocation.domain import commands
+from allocation.domain import commands, model
 from allocation.entrypoints.flask_utils import create_app
-from allocation.service_layer import handlers, unit_of_work
+from allocation.service_layer import (
+    handlers,
+    message_bus,
+    projector,
+    unit_of_work,
+)
 
 
 app = create_app()
 # with app.app_context:
-bus = bootstrap.bootstrap()
+read_model_projector = projector.from_config()
+bus = bootstrap.bootstrap(
+    read_uow=unit_of_work.ThreadLocalUnitOfWork(
+        unit_of_work.default_read_unit_of_work
+    ),
+    projector=read_model_projector,
+    executor=message_bus.executor_from_config(),
+)
 
 
 @app.route("/allocate", methods=["POST"])
@@ -26,12 +38,25 @@ def allocate():
 
 @app.route("/allocations/<order_id>", methods=["GET"])
 def allocations_view(order_id):
-    result = views.allocations(order_id, bus.uow)
+    result = views.allocations(order_id, bus.read_uow)
     if not result:
         return "Not Found", 404
     return jsonify(result), 201
 
 
+@app.route("/read-model/lag", methods=["GET"])
+def read_model_lag():
+    # this worker's events not yet in allocations_view, and how long, in
+    # seconds, the oldest of them has waited; without a projector they go
+    # in as they come up
+    if read_model_projector is None:
+        return {"pending": 0, "lag": 0.0}, 200
+    return {
+        "pending": read_model_projector.pending,
+        "lag": read_model_projector.lag,
+    }, 200
+
+
 @app.route("/batches/", methods=["POST"])
 def add_batch():
     eta = request.json["eta"]
@@ -43,6 +68,9 @@ def add_batch():
         request.json["qty"],
         eta,
     )
-    bus.handle(cmd)
+    try:
+        bus.handle(cmd)
+    except model.DuplicateBatch as e:
+        return {"message": str(e)}, 400
 
     return {"success": True}, 201
@@ -10,12 +10,11 @@ from allocation.service_layer import message_bus
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
-
 
 def main():
     logger.info("Redis pubsub starting")
     bus = bootstrap.bootstrap(message_queue_factory=deque)
+    r = redis.Redis(**config.get_redis_host_and_port())
     pubsub = r.pubsub(ignore_subscribe_messages=True)
     pubsub.subscribe(*CHANNELS)
 
@@ -0,0 +1,118 @@
+import asyncio
+from typing import Awaitable, Callable, Type, Dict, List
+from allocation.adapters.notifications import AbstractNotifications
+from allocation.domain import commands, model, events
+from allocation.service_layer import handlers
+from allocation.service_layer.unit_of_work import (
+    AbstractAsyncUnitOfWork,
+    AsyncSqlAlchemyUnitOfWork,
+)
+
+
+async def allocate(
+    command: commands.Allocate, uow: AbstractAsyncUnitOfWork
+) -> None:
+    async with uow:
+        product = await uow.products.get(command.sku)
+        await uow.run_sync(handlers.allocate_line, product, command)
+        await uow.commit()
+
+
+async def allocate_many(
+    command: commands.AllocateMany, uow: AbstractAsyncUnitOfWork
+) -> None:
+    async with uow:
+        product = await uow.products.get(command.sku)
+        await uow.run_sync(handlers.allocate_lines, product, command)
+        await uow.commit()
+
+
+async def reallocate(
+    event: events.Deallocated, uow: AbstractAsyncUnitOfWork
+) -> None:
+    async with uow:
+        handlers.request_reallocation(await uow.products.get(event.sku), event)
+        await uow.commit()
+
+
+async def add_batch(
+    command: commands.CreateBatch,
+    uow: AbstractAsyncUnitOfWork,
+) -> None:
+    async with uow:
+        product = await uow.products.get(command.sku)
+        if product is None:
+            product = handlers.new_product(command)
+            uow.products.add(product)
+        await uow.run_sync(handlers.add_batch_to, product, command)
+        await uow.commit()
+
+
+async def send_out_of_stock_notification(
+    event: events.OutOfStock, notifications: AbstractNotifications
+) -> None:
+    # notifications block, so they're sent from the loop's default executor
+    await asyncio.get_running_loop().run_in_executor(
+        None, notifications.send, *handlers.out_of_stock_email(event)
+    )
+
+
+async def change_batch_quantity(
+    command: commands.ChangeBatchQuantity,
+    uow: AbstractAsyncUnitOfWork,
+    deallocation_policy: model.DeallocationPolicy = model.fewest_lines,
+) -> None:
+    async with uow:
+        product = await uow.products.get(command.sku)
+        await uow.run_sync(
+            handlers.change_quantity, product, command, deallocation_policy
+        )
+        await uow.commit()
+
+
+async def publish_allocated_event(
+    event: events.Allocated, publish: Callable[..., Awaitable]
+) -> None:
+    await publish("line_allocated", event)
+
+
+async def add_allocation_to_read_model(
+    event: events.Allocated, uow: AsyncSqlAlchemyUnitOfWork
+) -> None:
+    async with uow:
+        await uow.apply_to_read_model([event])
+        await uow.commit()
+
+
+async def remove_allocation_from_read_model(
+    event: events.Deallocated, uow: AsyncSqlAlchemyUnitOfWork
+) -> None:
+    async with uow:
+        await uow.apply_to_read_model([event])
+        await uow.commit()
+
+
+# what a ReadModelProjector takes over when there is one
+READ_MODEL_HANDLERS = [
+    add_allocation_to_read_model,
+    remove_allocation_from_read_model,
+]
+
+EVENT_HANDLERS = {
+    events.OutOfStock: [send_out_of_stock_notification],
+    events.Allocated: [
+        publish_allocated_event,
+        add_allocation_to_read_model,
+    ],
+    events.Deallocated: [
+        reallocate,
+        remove_allocation_from_read_model,
+    ],
+}  # type: Dict[Type[events.Event], List[Callable]]
+
+COMMAND_HANDLERS = {
+    commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
+    commands.CreateBatch: add_batch,
+    commands.ChangeBatchQuantity: change_batch_quantity,
+}  # type: Dict[Type[commands.Command], Callable]
@@ -1,5 +1,6 @@
 from dataclasses import asdict
-from typing import Callable, Type, Dict, List
+from typing import Callable, Type, Dict, List, Optional, Tuple
+from allocation.adapters import read_model
 from allocation.adapters.notifications import AbstractNotifications
 from allocation.domain import commands, model, events
 from allocation.service_layer.unit_of_work import (
@@ -12,21 +13,81 @@ class InvalidSku(Exception):
     pass
 
 
+# what each handler does once it has its product, shared with the handlers
+# in async_handlers, which only differ in how they get and commit it
+
+
+def allocate_line(
+    product: Optional[model.Product], command: commands.Allocate
+) -> None:
+    if product is None:
+        raise InvalidSku(f"Invalid sku {command.sku}")
+    product.allocate(
+        model.OrderLine(command.order_id, command.sku, command.qty)
+    )
+
+
+def allocate_lines(
+    product: Optional[model.Product], command: commands.AllocateMany
+) -> None:
+    if product is None:
+        raise InvalidSku(f"Invalid sku {command.sku}")
+    product.allocate_many(
+        model.OrderLine(order_id, command.sku, qty)
+        for order_id, qty in command.lines
+    )
+
+
+def request_reallocation(
+    product: model.Product, event: events.Deallocated
+) -> None:
+    product.events.append(commands.Allocate(**asdict(event)))
+
+
+def new_product(command: commands.CreateBatch) -> model.Product:
+    return model.Product(command.sku, batches=[])
+
+
+def add_batch_to(
+    product: model.Product, command: commands.CreateBatch
+) -> None:
+    product.add_batch(
+        model.Batch(command.reference, command.sku, command.qty, command.eta)
+    )
+
+
+def change_quantity(
+    product: model.Product,
+    command: commands.ChangeBatchQuantity,
+    deallocation_policy: model.DeallocationPolicy,
+) -> None:
+    product.change_batch_quantity(
+        command.reference, command.sku, command.qty, deallocation_policy
+    )
+
+
+def out_of_stock_email(event: events.OutOfStock) -> Tuple[str, str]:
+    """The destination and message of an out of stock notification."""
+    return "test@example.com", f"out of stock {event.sku}"
+
+
 def allocate(command: commands.Allocate, uow: AbstractUnitOfWork) -> str:
     with uow:
-        product = uow.products.get(command.sku)
-        if product is None:
-            raise InvalidSku(f"Invalid sku {command.sku}")
-        product.allocate(
-            model.OrderLine(command.order_id, command.sku, command.qty)
-        )
+        allocate_line(uow.products.get(command.sku), command)
+        uow.commit()
+
+
+def allocate_many(
+    command: commands.AllocateMany, uow: AbstractUnitOfWork
+) -> None:
+    with uow:
+        allocate_lines(uow.products.get(command.sku), command)
         uow.commit()
 
 
 def reallocate(event: events.Deallocated, uow: AbstractUnitOfWork):
     with uow:
-        product = uow.products.get(event.sku)
-        product.events.append(commands.Allocate(**asdict(event)))
+        request_reallocation(uow.products.get(event.sku), event)
         uow.commit()
 
 
@@ -37,30 +98,26 @@ def add_batch(
     with uow:
         product = uow.products.get(command.sku)
         if product is None:
-            product = model.Product(command.sku, batches=[])
+            product = new_product(command)
             uow.products.add(product)
-
-        product.batches.append(
-            model.Batch(
-                command.reference, command.sku, command.qty, command.eta
-            )
-        )
+        add_batch_to(product, command)
         uow.commit()
 
 
 def send_out_of_stock_notification(
     event: events.OutOfStock, notifications: AbstractNotifications
 ):
-    notifications.send("test@example.com", f"out of stock {event.sku}")
+    notifications.send(*out_of_stock_email(event))
 
 
 def change_batch_quantity(
-    command: commands.ChangeBatchQuantity, uow: AbstractUnitOfWork
+    command: commands.ChangeBatchQuantity,
+    uow: AbstractUnitOfWork,
+    deallocation_policy: model.DeallocationPolicy = model.fewest_lines,
 ):
     with uow:
-        product = uow.products.get(command.sku)
-        product.change_batch_quantity(
-            command.reference, command.sku, command.qty
+        change_quantity(
+            uow.products.get(command.sku), command, deallocation_policy
         )
         uow.commit()
 
@@ -73,17 +130,7 @@ def add_allocation_to_read_model(
     event: events.Allocated, uow: SqlAlchemyUnitOfWork
 ):
     with uow:
-        uow.session.execute(
-            """
-            INSERT INTO allocations_view (order_id, sku, batch_ref)
-            VALUES (:order_id, :sku, :batch_ref)
-            """,
-            dict(
-                order_id=event.order_id,
-                sku=event.sku,
-                batch_ref=event.batch_ref,
-            ),
-        )
+        read_model.apply(uow.session_for, [event])
         uow.commit()
 
 
@@ -91,13 +138,16 @@ def remove_allocation_from_read_model(
     event: events.Deallocated, uow: SqlAlchemyUnitOfWork
 ):
     with uow:
-        uow.session.execute(
-            "DELETE FROM allocations_view WHERE sku= :sku AND order_id= :order_id",
-            dict(sku=event.sku, order_id=event.order_id),
-        )
+        read_model.apply(uow.session_for, [event])
         uow.commit()
 
 
+# what a ReadModelProjector takes over when there is one
+READ_MODEL_HANDLERS = [
+    add_allocation_to_read_model,
+    remove_allocation_from_read_model,
+]
+
 EVENT_HANDLERS = {
     events.OutOfStock: [send_out_of_stock_notification],
     events.Allocated: [
@@ -112,6 +162,7 @@ EVENT_HANDLERS = {
 
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
 }  # type: Dict[Type[commands.Command], Callable]
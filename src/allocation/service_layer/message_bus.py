@@ -1,12 +1,87 @@
-from typing import Callable, Dict, Iterable, List, Type, Union
+import asyncio
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Type,
+    Union,
+)
 import logging
+import threading
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    stop_after_delay,
+    wait_random_exponential,
+)
+from allocation import config
 from allocation.domain import events, commands
-from allocation.service_layer.unit_of_work import AbstractUnitOfWork
+from allocation.service_layer.unit_of_work import (
+    AbstractAsyncUnitOfWork,
+    AbstractUnitOfWork,
+    is_concurrency_conflict,
+)
 
 Message = Union[events.Event, commands.Command]
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class RetryPolicy:
+    """
+    How a command that lost a race with a concurrent one gets retried:
+    up to `attempts` tries in all, waiting a random time of up to
+    `backoff` seconds (doubling each time, capped at `max_backoff`),
+    and giving up once `budget` seconds have gone by.
+    """
+
+    attempts: int = 5
+    backoff: float = 0.01
+    max_backoff: float = 0.2
+    budget: float = 1.0
+
+    def retrying(self) -> Retrying:
+        return Retrying(**self._arguments())
+
+    def async_retrying(self) -> AsyncRetrying:
+        return AsyncRetrying(**self._arguments())
+
+    def _arguments(self) -> Dict[str, Any]:
+        return dict(
+            stop=stop_after_attempt(self.attempts)
+            | stop_after_delay(self.budget),
+            wait=wait_random_exponential(
+                multiplier=self.backoff, max=self.max_backoff
+            ),
+            retry=retry_if_exception(is_concurrency_conflict),
+            reraise=True,
+        )
+
+
+def uses_unit_of_work(handler: Callable) -> bool:
+    # bootstrap marks the handlers it injects; assume the rest do
+    return getattr(handler, "uses_uow", True)
+
+
+def executor_from_config() -> Optional[Executor]:
+    """The pool the settings ask event handlers to run on, if any."""
+    if not config.get_event_handler_threads():
+        return None
+    return ThreadPoolExecutor(
+        config.get_event_handler_threads(),
+        thread_name_prefix="event-handler",
+    )
+
+
 class MessageBus:
     def __init__(
         self,
@@ -14,19 +89,51 @@ class MessageBus:
         message_queue_factory: Callable,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        retry_policy: RetryPolicy = RetryPolicy(),
+        read_uow: Optional[AbstractUnitOfWork] = None,
+        after_handle: Iterable[Callable[[], None]] = (),
+        executor: Optional[Executor] = None,
     ):
         self.uow = uow
+        # for views, which don't need to share the handlers' connections
+        self.read_uow = read_uow or uow
         self.queue_factory = message_queue_factory
         # defer creating the message_queue until calling the "handle" method
         # which will happen inside a view function which provide the app context
-        # needed to access "flask.g" object
-        self.queue = None
+        # needed to access "flask.g" object, and keep one per thread for
+        # servers handling several requests at once
+        self._local = threading.local()
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.retry_policy = retry_policy
+        # run once a message and everything it led to have been handled
+        self.after_handle = list(after_handle)
+        # runs an event's handlers that don't use the unit of work alongside
+        # the ones that do, which can't share it across threads
+        self.executor = executor
+
+    @property
+    def queue(self):
+        return getattr(self._local, "queue", None)
+
+    @queue.setter
+    def queue(self, queue) -> None:
+        self._local.queue = queue
 
     def handle(self, message: Message):
         self.queue = self.queue_factory()
         self.queue.append(message)
+        try:
+            with self.uow.scope():
+                self._handle_queue()
+        finally:
+            for hook in self.after_handle:
+                try:
+                    hook()
+                except Exception:
+                    logging.exception(f"Exception in after_handle {hook}")
+
+    def _handle_queue(self) -> None:
         while self.queue:
             message = self.queue.popleft()
             if isinstance(message, events.Event):
@@ -40,7 +147,20 @@ class MessageBus:
         self,
         event: events.Event,
     ) -> None:
-        for handler in self.event_handlers[type(event)]:
+        handlers = self.event_handlers[type(event)]
+        background = []
+        if self.executor is not None:
+            background = [
+                (handler, self.executor.submit(handler, event))
+                for handler in handlers
+                if not uses_unit_of_work(handler)
+            ]
+        in_background = {handler for handler, _ in background}
+        # the rest run here and in order, so the events they raise are
+        # queued in the same order whatever the background ones do
+        for handler in handlers:
+            if handler in in_background:
+                continue
             try:
                 logger.debug(f"handling event {event} with handler {handler}")
                 handler(event)
@@ -48,6 +168,11 @@ class MessageBus:
             except Exception:
                 logging.exception(f"Exception handling event {event}")
                 continue
+        for handler, future in background:
+            try:
+                future.result()
+            except Exception:
+                logging.exception(f"Exception handling event {event}")
 
     def handle_command(
         self,
@@ -56,8 +181,85 @@ class MessageBus:
         logging.debug(f"handling command {command}")
         try:
             handler = self.command_handlers[type(command)]
-            handler(command)
+            for attempt in self.retry_policy.retrying():
+                with attempt:
+                    handler(command)
             self.queue.extend(self.uow.collect_new_events())
         except Exception:
             logging.exception(f"Exception handling command {command}")
             raise
+
+
+class AsyncMessageBus:
+    """
+    A MessageBus for asyncio code, whose handlers are coroutines. Each
+    handle() call keeps its own queue, so one event loop can have many in
+    progress at once; the unit of work keeps a session per task for the
+    same reason.
+    """
+
+    def __init__(
+        self,
+        uow: AbstractAsyncUnitOfWork,
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        command_handlers: Dict[Type[commands.Command], Callable],
+        retry_policy: RetryPolicy = RetryPolicy(),
+    ):
+        self.uow = uow
+        self.event_handlers = event_handlers
+        self.command_handlers = command_handlers
+        self.retry_policy = retry_policy
+
+    async def handle(self, message: Message):
+        queue = deque([message])  # type: Deque[Message]
+        while queue:
+            message = queue.popleft()
+            if isinstance(message, events.Event):
+                await self.handle_event(message, queue)
+            elif isinstance(message, commands.Command):
+                await self.handle_command(message, queue)
+            else:
+                raise Exception(f"{message} is not an Event or a Command")
+
+    async def handle_event(
+        self,
+        event: events.Event,
+        queue: Deque[Message],
+    ) -> None:
+        handlers = self.event_handlers[type(event)]
+        # the ones that don't use the unit of work run alongside the rest,
+        # which run in order so that they queue new events in order
+        background = [
+            asyncio.ensure_future(handler(event))
+            for handler in handlers
+            if not uses_unit_of_work(handler)
+        ]
+        for handler in filter(uses_unit_of_work, handlers):
+            try:
+                logger.debug(f"handling event {event} with handler {handler}")
+                await handler(event)
+                queue.extend(self.uow.collect_new_events())
+            except Exception:
+                logging.exception(f"Exception handling event {event}")
+                continue
+        for task in background:
+            try:
+                await task
+            except Exception:
+                logging.exception(f"Exception handling event {event}")
+
+    async def handle_command(
+        self,
+        command: commands.Command,
+        queue: Deque[Message],
+    ):
+        logging.debug(f"handling command {command}")
+        try:
+            handler = self.command_handlers[type(command)]
+            async for attempt in self.retry_policy.async_retrying():
+                with attempt:
+                    await handler(command)
+            queue.extend(self.uow.collect_new_events())
+        except Exception:
+            logging.exception(f"Exception handling command {command}")
+            raise
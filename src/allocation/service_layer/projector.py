@@ -0,0 +1,131 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import List, Optional, Union
+from allocation import config
+from allocation.adapters import read_model
+from allocation.domain import events
+from allocation.service_layer import unit_of_work
+
+ReadModelEvent = Union[events.Allocated, events.Deallocated]
+logger = logging.getLogger(__name__)
+
+
+class ReadModelProjector:
+    """
+    Keeps allocations_view up to date like the read model handlers do, but
+    buffers Allocated and Deallocated events and applies them in one
+    transaction of multi-row DELETEs and INSERTs. A flush happens once
+    `max_size` events are waiting, or once the oldest has waited
+    `max_delay` seconds and flush_if_due() is called, which the message
+    bus does after each message it handles. With `background` set, a
+    daemon thread also calls it every `max_delay` seconds, so the last
+    events before a quiet spell don't wait for more traffic, and whatever
+    is left is flushed when the process exits.
+    """
+
+    def __init__(
+        self,
+        uow: unit_of_work.SqlAlchemyUnitOfWork,
+        max_size: int = 500,
+        max_delay: float = 0.5,
+        background: bool = False,
+    ) -> None:
+        self.uow = uow
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.background = background
+        # the process the flushing thread runs in, if it's been started
+        self._flusher_pid = None  # type: Optional[int]
+        self._buffer = []  # type: List[ReadModelEvent]
+        self._oldest = None  # type: Optional[float]
+        self._lock = threading.Lock()
+        # flushes must reach the database in the order they were taken
+        self._flush_lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def lag(self) -> float:
+        """How long, in seconds, the oldest unapplied event has waited."""
+        oldest = self._oldest
+        return time.monotonic() - oldest if oldest is not None else 0.0
+
+    def handle(self, event: ReadModelEvent) -> None:
+        with self._lock:
+            if self.background and self._flusher_pid != os.getpid():
+                self._start_flusher()
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append(event)
+            full = len(self._buffer) >= self.max_size
+        if full:
+            self.flush()
+
+    def flush_if_due(self) -> None:
+        if self._buffer and self.lag >= self.max_delay:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                buffered, self._buffer = self._buffer, []
+                oldest, self._oldest = self._oldest, None
+            if not buffered:
+                return
+            try:
+                self._apply(buffered)
+            except Exception:
+                # put them back in front of anything buffered since
+                with self._lock:
+                    self._buffer[:0] = buffered
+                    self._oldest = oldest
+                raise
+            # how far behind the read model was, for whoever watches it
+            logger.info(
+                f"Applied {len(buffered)} read model events"
+                f" {time.monotonic() - oldest:.3f}s after the oldest came up,"
+                f" {self.pending} more buffered since"
+            )
+
+    def _start_flusher(self) -> None:
+        # started by the first event each process buffers, rather than when
+        # the projector is made, so that processes forked after that get a
+        # thread of their own
+        self._flusher_pid = os.getpid()
+        threading.Thread(
+            target=self._flush_when_due,
+            name="read-model-projector",
+            daemon=True,
+        ).start()
+        atexit.register(self.flush)
+
+    def _flush_when_due(self) -> None:
+        while True:
+            time.sleep(max(self.max_delay, 0.01))
+            try:
+                self.flush_if_due()
+            except Exception:
+                # the events stay buffered for the next attempt
+                logger.exception("Exception flushing the read model")
+
+    def _apply(self, buffered: List[ReadModelEvent]) -> None:
+        with self.uow:
+            read_model.apply(self.uow.session_for, buffered)
+            self.uow.commit()
+
+
+def from_config() -> Optional[ReadModelProjector]:
+    """The projector the settings ask for, if any."""
+    if not config.get_read_model_batch_size():
+        return None
+    return ReadModelProjector(
+        unit_of_work.default_unit_of_work(),
+        max_size=config.get_read_model_batch_size(),
+        max_delay=config.get_read_model_max_delay(),
+        background=True,
+    )
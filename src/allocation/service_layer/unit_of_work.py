@@ -1,9 +1,26 @@
 from abc import ABC, abstractmethod
-from typing import Generator
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+from typing import (
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import zlib
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from allocation.adapters import repository
-from allocation.domain import events
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+from allocation.adapters import read_model, repository
+from allocation.adapters.process_local import ProcessLocal
+from allocation.domain import events, model
 from allocation import config
 
 
@@ -19,10 +36,16 @@ class AbstractUnitOfWork(ABC):
     def commit(self):
         self._commit()
 
-    def collect_new_events(self) -> Generator[events.Event, None, None]:
-        for product in self.products.seen:
-            while product.events:
-                yield product.events.pop(0)
+    @contextmanager
+    def scope(self) -> Iterator[None]:
+        """
+        Brackets everything one MessageBus.handle() call leads to. Units of
+        work can keep state, such as a session, across it.
+        """
+        yield
+
+    def collect_new_events(self) -> Iterator[events.Event]:
+        return iter(self.products.outbox.drain())
 
     @abstractmethod
     def _commit(self):
@@ -33,29 +56,468 @@ class AbstractUnitOfWork(ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
+def make_session_factory(
+    uri: str, isolation_level: Optional[str] = None
+) -> sessionmaker:
+    return sessionmaker(
+        bind=create_engine(
+            uri,
+            isolation_level=isolation_level or config.get_isolation_level(),
+        )
+    )
+
+
+class LazySessionFactory:
+    """
+    Opens sessions like a sessionmaker, but only creates its engine for the
+    first one, and creates a new one in each forked process.
+    """
+
+    def __init__(self, uri: str, isolation_level: Optional[str] = None):
+        self._sessionmaker = ProcessLocal(
+            lambda: make_session_factory(uri, isolation_level)
+        )
+
+    def __call__(self, **kwargs) -> Session:
+        return self._sessionmaker.get()(**kwargs)
+
+
+def make_async_session_factory(
+    uri: str, isolation_level: Optional[str] = None
+) -> sessionmaker:
+    return sessionmaker(
+        bind=create_async_engine(
+            uri,
+            isolation_level=isolation_level or config.get_isolation_level(),
+        ),
+        class_=AsyncSession,
     )
+
+
+class LazyAsyncSessionFactory(LazySessionFactory):
+    """A LazySessionFactory opening AsyncSessions."""
+
+    def __init__(self, uri: str, isolation_level: Optional[str] = None):
+        self._sessionmaker = ProcessLocal(
+            lambda: make_async_session_factory(uri, isolation_level)
+        )
+
+
+DEFAULT_SESSION_FACTORY = LazySessionFactory(config.get_postgres_uri())
+DEFAULT_ASYNC_SESSION_FACTORY = LazyAsyncSessionFactory(
+    config.get_async_postgres_uri()
 )
+DEFAULT_SHARD_SESSION_FACTORIES = [
+    LazySessionFactory(uri) for uri in config.get_shard_uris()
+]
+DEFAULT_READ_SESSION_FACTORIES = [
+    LazySessionFactory(uri, config.get_read_isolation_level())
+    for uri in config.get_replica_uris()
+]
+DEFAULT_PRODUCT_CACHE = None  # type: Optional[repository.ProductCache]
+if config.get_product_cache_size():
+    DEFAULT_PRODUCT_CACHE = repository.ProductCache(
+        config.get_product_cache_size()
+    )
+DEFAULT_LOCK_MODE = config.get_lock_mode()
+
+
+# serialization_failure, deadlock_detected, lock_not_available (NOWAIT)
+CONFLICT_SQLSTATES = {"40001", "40P01", "55P03"}
+
+
+def is_concurrency_conflict(exception: Exception) -> bool:
+    """Whether a unit of work failed only because of a concurrent one."""
+    if isinstance(exception, (StaleDataError, repository.ProductLocked)):
+        return True
+    if isinstance(exception, DBAPIError):
+        return getattr(exception.orig, "pgcode", None) in CONFLICT_SQLSTATES
+    return False
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        loading_strategy: Optional[str] = None,
+        product_cache: Optional[repository.ProductCache] = None,
+        lock_mode: Optional[str] = None,
+        project_read_model: bool = False,
+        scoped: bool = False,
+    ):
         self.session_factory = session_factory
+        self.loading_strategy = loading_strategy
+        self.product_cache = product_cache
+        # see repository.LOCK_MODES
+        self.lock_mode = lock_mode
+        # write allocations_view rows as part of each commit, instead of
+        # leaving them to the read model handlers
+        self.project_read_model = project_read_model
+        # keep one session, and its identity map, for a whole scope, with
+        # each handler still committing on its own
+        self.scoped = scoped
+        self._in_scope = False
+        self._committed = []  # type: List[model.Product]
 
     def __enter__(self):
-        self.session = self.session_factory()
-        self.products = repository.SqlAlchemyRepository(self.session)
+        if not self._in_scope:
+            self._open()
         return super().__enter__()
 
     def __exit__(self, *args):
         super().__exit__(*args)
-        self.session.close()
+        if not self._in_scope:
+            self._close()
+
+    @contextmanager
+    def scope(self) -> Iterator[None]:
+        if not self.scoped or self._in_scope:
+            yield
+            return
+        self._open()
+        self._in_scope = True
+        try:
+            yield
+        finally:
+            self._in_scope = False
+            self._close()
+            self._release_committed()
+
+    def session_for(self, sku: str):
+        """The session the given sku's product and read model live in."""
+        return self.session
+
+    def shard_sessions(self) -> List:
+        """A session on every database products are kept in."""
+        return [self.session]
+
+    def _open(self) -> None:
+        self.session = self._open_session(self.session_factory)
+        self._new_repository()
+
+    def _new_repository(self) -> None:
+        self.products = self._repository(self.session)
+
+    def _close(self) -> None:
+        for session in self._open_sessions():
+            session.close()
+
+    def _open_session(self, session_factory):
+        if self.product_cache is None and not self.scoped:
+            return session_factory()
+        # cached products have to outlive their session fully loaded, and a
+        # scope's products outlive each handler's commit
+        return session_factory(expire_on_commit=False)
+
+    def _open_sessions(self) -> List:
+        return [self.session]
+
+    def _repository(self, session) -> repository.SqlAlchemyRepository:
+        return repository.SqlAlchemyRepository(
+            session,
+            self.loading_strategy,
+            self.product_cache,
+            self.lock_mode,
+            reuse_loaded=self.scoped,
+        )
+
+    def collect_new_events(self) -> Generator[events.Event, None, None]:
+        yield from super().collect_new_events()
+        # committed products go back into the cache only once their events
+        # are out, so whoever checks them out next starts clean, and only
+        # once the scope they're part of is over
+        if not self._in_scope:
+            self._release_committed()
+
+    def _release_committed(self) -> None:
+        if self.product_cache is not None:
+            self.product_cache.put(self._committed)
+        self._committed = []
+
+    def _commit(self):
+        if self.project_read_model:
+            read_model.apply(self.session_for, self.products.outbox.peek_new())
+        for session in self._open_sessions():
+            session.commit()
+        self._committed = list(self.products.seen)
+
+    def rollback(self):
+        rolled_back = False
+        for session in self._open_sessions():
+            rolled_back = rolled_back or session.in_transaction()
+            session.rollback()
+        if not rolled_back:
+            return
+        # rolling back expires everything in the session, which cached
+        # products mustn't be
+        self._committed = []
+        if self._in_scope:
+            # a scope's products outlive the rollback, but nothing the
+            # rolled back work did to them may: not the events it raised,
+            # nor indexes built on quantities the database no longer has
+            for product in self.products.seen:
+                product.events = []
+                product.invalidate_indexes()
+            self._new_repository()
+
+
+def shard_for(sku: str, shards: int) -> int:
+    """The shard a sku lives on, the same in every process and run."""
+    return zlib.crc32(sku.encode()) % shards
+
+
+class ShardedSqlAlchemyUnitOfWork(SqlAlchemyUnitOfWork):
+    """
+    Products spread over one database per session factory by sku. Sessions
+    are only opened on the shards a unit of work touches, and are committed
+    one after the other: handlers change a single product at a time, which
+    keeps each of them on a single shard.
+    """
+
+    def __init__(
+        self,
+        session_factories: Iterable[Callable[..., Session]],
+        loading_strategy: Optional[str] = None,
+        product_cache: Optional[repository.ProductCache] = None,
+        lock_mode: Optional[str] = None,
+        project_read_model: bool = False,
+        scoped: bool = False,
+    ):
+        super().__init__(
+            None,
+            loading_strategy,
+            product_cache,
+            lock_mode,
+            project_read_model,
+            scoped,
+        )
+        self.session_factories = list(session_factories)
+
+    def _open(self) -> None:
+        # by shard, filled in as the unit of work reaches each shard
+        self.sessions = {}  # type: Dict[int, Session]
+        self._new_repository()
+
+    def _new_repository(self) -> None:
+        self._shards = {}  # type: Dict[int, repository.SqlAlchemyRepository]
+        self.products = repository.ShardedSqlAlchemyRepository(
+            self._repository_for
+        )
+
+    def session_for(self, sku: str):
+        return self._session_on(shard_for(sku, len(self.session_factories)))
+
+    def shard_sessions(self) -> List:
+        return [
+            self._session_on(shard)
+            for shard in range(len(self.session_factories))
+        ]
+
+    def _session_on(self, shard: int):
+        if shard not in self.sessions:
+            self.sessions[shard] = self._open_session(
+                self.session_factories[shard]
+            )
+        return self.sessions[shard]
+
+    def _open_sessions(self) -> List:
+        return list(self.sessions.values())
+
+    def _repository_for(self, sku: str) -> repository.SqlAlchemyRepository:
+        shard = shard_for(sku, len(self.session_factories))
+        if shard not in self._shards:
+            self._shards[shard] = self._repository(self._session_on(shard))
+        return self._shards[shard]
+
+
+class ReadOnlyWorkError(Exception):
+    pass
+
+
+class ReadOnlyUnitOfWork(SqlAlchemyUnitOfWork):
+    """
+    For views: never commits, so it can read from a replica, and keeps
+    view traffic off the connections handlers use.
+    """
+
+    def _commit(self):
+        raise ReadOnlyWorkError("Read-only units of work can't commit")
+
+
+class ShardedReadOnlyUnitOfWork(
+    ReadOnlyUnitOfWork, ShardedSqlAlchemyUnitOfWork
+):
+    pass
+
+
+class ThreadLocalUnitOfWork(AbstractUnitOfWork):
+    """
+    Stands in for a unit of work per thread, each made by `factory` the
+    first time its thread uses it, so that threads serving requests at the
+    same time never share a session or a repository.
+    """
+
+    def __init__(self, factory: Callable[[], AbstractUnitOfWork]):
+        self.factory = factory
+        self._local = threading.local()
+
+    @property
+    def current(self) -> AbstractUnitOfWork:
+        """This thread's unit of work."""
+        uow = getattr(self._local, "uow", None)
+        if uow is None:
+            uow = self._local.uow = self.factory()
+        return uow
+
+    @property
+    def products(self) -> repository.AbstractRepository:
+        return self.current.products
+
+    def __enter__(self):
+        self.current.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.current.__exit__(*args)
+
+    def __getattr__(self, name: str):
+        # session_for(), shard_sessions() and the like
+        return getattr(self.current, name)
+
+    def scope(self):
+        return self.current.scope()
+
+    def collect_new_events(self) -> Iterator[events.Event]:
+        return self.current.collect_new_events()
 
     def _commit(self):
-        self.session.commit()
+        self.current.commit()
 
     def rollback(self):
-        self.session.rollback()
+        self.current.rollback()
+
+
+def default_unit_of_work() -> SqlAlchemyUnitOfWork:
+    if DEFAULT_SHARD_SESSION_FACTORIES:
+        return ShardedSqlAlchemyUnitOfWork(
+            DEFAULT_SHARD_SESSION_FACTORIES,
+            product_cache=DEFAULT_PRODUCT_CACHE,
+            lock_mode=DEFAULT_LOCK_MODE,
+            project_read_model=config.get_read_model_in_transaction(),
+            scoped=config.get_scoped_sessions(),
+        )
+    return SqlAlchemyUnitOfWork(
+        product_cache=DEFAULT_PRODUCT_CACHE,
+        lock_mode=DEFAULT_LOCK_MODE,
+        project_read_model=config.get_read_model_in_transaction(),
+        scoped=config.get_scoped_sessions(),
+    )
+
+
+def default_read_unit_of_work() -> ReadOnlyUnitOfWork:
+    if len(DEFAULT_READ_SESSION_FACTORIES) > 1:
+        return ShardedReadOnlyUnitOfWork(DEFAULT_READ_SESSION_FACTORIES)
+    return ReadOnlyUnitOfWork(DEFAULT_READ_SESSION_FACTORIES[0])
+
+
+class AbstractAsyncUnitOfWork(ABC):
+    products: repository.AsyncSqlAlchemyRepository
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.rollback()
+
+    async def commit(self):
+        await self._commit()
+
+    def collect_new_events(self) -> Iterator[events.Event]:
+        return iter(self.products.outbox.drain())
+
+    async def run_sync(self, fn: Callable, *args):
+        """Call fn with args from wherever the products can do IO."""
+        return fn(*args)
+
+    @abstractmethod
+    async def _commit(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def rollback(self):
+        raise NotImplementedError
+
+
+# an AsyncSqlAlchemyUnitOfWork's session and repository, in one task
+_AsyncWork = Tuple[AsyncSession, repository.AsyncSqlAlchemyRepository]
+
+
+class AsyncSqlAlchemyUnitOfWork(AbstractAsyncUnitOfWork):
+    """
+    A unit of work for asyncio code, over SQLAlchemy's AsyncSession. Its
+    session and repository are kept in a context variable, so every task
+    using it gets its own and many can be in the middle of one at once.
+    """
+
+    def __init__(
+        self,
+        session_factory=DEFAULT_ASYNC_SESSION_FACTORY,
+        lock_mode: Optional[str] = None,
+        project_read_model: bool = False,
+    ):
+        self.session_factory = session_factory
+        self.lock_mode = lock_mode
+        # like SqlAlchemyUnitOfWork's, writes allocations_view as it commits
+        self.project_read_model = project_read_model
+        name = f"async_unit_of_work_{id(self)}"
+        self._current = ContextVar(name)  # type: ContextVar[_AsyncWork]
+
+    @property
+    def session(self) -> AsyncSession:
+        return self._current.get()[0]
+
+    @property
+    def products(self) -> repository.AsyncSqlAlchemyRepository:
+        return self._current.get()[1]
+
+    async def __aenter__(self):
+        # nothing may be expired once committed: reloading it would need IO
+        session = self.session_factory(expire_on_commit=False)
+        products = repository.AsyncSqlAlchemyRepository(
+            session, self.lock_mode
+        )
+        self._current.set((session, products))
+        return await super().__aenter__()
+
+    async def __aexit__(self, *args):
+        await super().__aexit__(*args)
+        await self.session.close()
+
+    def session_for(self, sku: str) -> AsyncSession:
+        return self.session
+
+    async def run_sync(self, fn: Callable, *args):
+        # a batch's allocations are queried as the model needs them, which
+        # only works in the session's greenlet
+        return await self.session.run_sync(lambda _: fn(*args))
+
+    async def apply_to_read_model(self, messages: Iterable) -> None:
+        """read_model.apply(), through this unit of work's session."""
+        await self.session.run_sync(
+            lambda session: read_model.apply(lambda sku: session, messages)
+        )
+
+    async def _commit(self):
+        if self.project_read_model:
+            await self.apply_to_read_model(self.products.outbox.peek_new())
+        await self.session.commit()
+
+    async def rollback(self):
+        await self.session.rollback()
+
+
+def default_async_unit_of_work() -> AsyncSqlAlchemyUnitOfWork:
+    return AsyncSqlAlchemyUnitOfWork(
+        lock_mode=DEFAULT_LOCK_MODE,
+        project_read_model=config.get_read_model_in_transaction(),
+    )
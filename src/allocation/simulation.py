@@ -0,0 +1,177 @@
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from allocation.domain import model
+
+# how many lines of a product's stream are looked at at once when sending a
+# run of lines to the same batch
+WINDOW = 4096
+
+
+@dataclass
+class SimulationResult:
+    # the batch each line of the stream went to, None where it wasn't
+    # allocated
+    batch_refs: List[Optional[str]] = field(default_factory=list)
+    requested: Dict[str, int] = field(default_factory=dict)
+    allocated: Dict[str, int] = field(default_factory=dict)
+    # (position in the stream, sku) for every line that ran out of stock
+    out_of_stock: List[Tuple[int, str]] = field(default_factory=list)
+    # quantity taken from each batch over the run, by batch reference
+    consumption: Dict[str, int] = field(default_factory=dict)
+
+    def fill_rate(self, sku: Optional[str] = None) -> float:
+        skus = [sku] if sku is not None else list(self.requested)
+        requested = sum(self.requested.get(s, 0) for s in skus)
+        allocated = sum(self.allocated.get(s, 0) for s in skus)
+        return allocated / requested if requested else 1.0
+
+
+@dataclass(frozen=True)
+class _ProductSnapshot:
+    references: List[str]
+    remaining: np.ndarray
+    lines: List[FrozenSet[model.OrderLine]]
+
+
+class Snapshot:
+    """
+    The batches of a set of products, frozen in allocation order so that
+    order streams can be replayed against them without touching the
+    products themselves.
+    """
+
+    def __init__(self, products: Iterable[model.Product]) -> None:
+        self._products = {}  # type: Dict[str, _ProductSnapshot]
+        for product in products:
+            # allocate() skips batches whose sku doesn't match the line's,
+            # and every line replayed against a product has its sku
+            batches = [
+                b
+                for b in model.BatchOrder(product.batches)
+                if b.sku == product.sku
+            ]
+            self._products[product.sku] = _ProductSnapshot(
+                references=[b.reference for b in batches],
+                remaining=np.array(
+                    [b.available_quantity for b in batches], dtype=np.int64
+                ),
+                lines=[frozenset(b._allocations) for b in batches],
+            )
+
+    def __contains__(self, sku: str) -> bool:
+        return sku in self._products
+
+    def simulate(self, lines: Iterable[model.OrderLine]) -> SimulationResult:
+        """
+        Replay a stream of order lines, making the same choices as calling
+        Product.allocate() for each line in turn.
+        """
+        lines = list(lines)
+        result = SimulationResult(batch_refs=[None] * len(lines))
+        positions_by_sku = defaultdict(list)  # type: Dict[str, List[int]]
+        for position, line in enumerate(lines):
+            positions_by_sku[line.sku].append(position)
+            result.requested[line.sku] = (
+                result.requested.get(line.sku, 0) + line.qty
+            )
+
+        # products never share batches, so each sku's lines can be replayed
+        # on their own
+        for sku, positions in positions_by_sku.items():
+            if sku in self._products:
+                self._replay(
+                    self._products[sku],
+                    [lines[p] for p in positions],
+                    positions,
+                    result,
+                )
+        result.out_of_stock.sort()
+        return result
+
+    @staticmethod
+    def _line_codes(
+        product: _ProductSnapshot, lines: List[model.OrderLine]
+    ) -> Tuple[np.ndarray, np.ndarray, Dict[int, Set[int]]]:
+        """
+        Number the lines so that equal lines share a number, and find the
+        batches already holding each line that comes up more than once.
+        Only those lines can turn out to be repeat allocations.
+        """
+        sku = lines[0].sku
+        held = [
+            (i, line)
+            for i, batch_lines in enumerate(product.lines)
+            for line in batch_lines
+            if line.sku == sku
+        ]
+        all_lines = [line for _, line in held] + lines
+        _, ids = np.unique(
+            np.array([line.order_id for line in all_lines]),
+            return_inverse=True,
+        )
+        qtys = np.array([line.qty for line in all_lines], dtype=np.int64)
+        _, codes = np.unique(
+            np.stack([ids.ravel(), qtys]), axis=1, return_inverse=True
+        )
+        codes = codes.ravel()
+        shared = np.bincount(codes)[codes] > 1
+        holders = defaultdict(set)  # type: Dict[int, Set[int]]
+        for (i, _), code, is_shared in zip(held, codes, shared):
+            if is_shared:
+                holders[int(code)].add(i)
+        return codes[len(held) :], shared[len(held) :], holders
+
+    @staticmethod
+    def _replay(
+        product: _ProductSnapshot,
+        lines: List[model.OrderLine],
+        positions: List[int],
+        result: SimulationResult,
+    ) -> None:
+        remaining = product.remaining.copy()
+        consumed = np.zeros_like(remaining)
+        chosen = np.full(len(lines), -1, dtype=np.int64)
+        qtys = np.array([line.qty for line in lines], dtype=np.int64)
+        codes, shared, holders = Snapshot._line_codes(product, lines)
+
+        start = 0
+        while start < len(lines):
+            run = model.allocation_run(
+                remaining, remaining >= qtys[start], qtys, start, WINDOW
+            )
+            if run is None:
+                # nothing changes until a line some batch can take comes up
+                most = remaining.max() if len(remaining) else -1
+                stuck = qtys[start : start + WINDOW] > most
+                end = start + (
+                    len(stuck) if stuck.all() else int((~stuck).argmax())
+                )
+                result.out_of_stock.extend(
+                    (positions[offset], lines[offset].sku)
+                    for offset in range(start, end)
+                )
+                start = end
+                continue
+            i, end = run
+
+            chosen[start:end] = i
+            taken = int(qtys[start:end][~shared[start:end]].sum())
+            for offset in start + np.flatnonzero(shared[start:end]):
+                # allocating a line a batch already holds changes nothing
+                code = int(codes[offset])
+                if i not in holders[code]:
+                    holders[code].add(i)
+                    taken += int(qtys[offset])
+            remaining[i] -= taken
+            consumed[i] += taken
+            start = end
+
+        for offset in np.flatnonzero(chosen >= 0):
+            result.batch_refs[positions[offset]] = product.references[
+                chosen[offset]
+            ]
+        result.allocated[lines[0].sku] = int(qtys[chosen >= 0].sum())
+        for i in np.flatnonzero(consumed):
+            result.consumption[product.references[i]] = int(consumed[i])
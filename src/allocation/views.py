@@ -3,12 +3,16 @@ from allocation.service_layer import unit_of_work
 
 
 def allocations(order_id: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+    # an order's lines can be for skus on any shard
     with uow:
-        result = uow.session.execute(
-            """
-            SELECT sku, batch_ref FROM allocations_view
-            WHERE order_id = :order_id
-            """,
-            dict(order_id=order_id),
-        )
-    return [dict(r) for r in result]
+        return [
+            dict(r)
+            for session in uow.shard_sessions()
+            for r in session.execute(
+                """
+                SELECT sku, batch_ref FROM allocations_view
+                WHERE order_id = :order_id
+                """,
+                dict(order_id=order_id),
+            )
+        ]
@@ -25,3 +25,7 @@ def post_to_allocate(order_id, sku, qty, expect_success=True):
 def get_allocations(order_id):
     url = f"{config.get_api_url()}/allocations/{order_id}"
     return requests.get(url)
+
+
+def get_read_model_lag():
+    return requests.get(f"{config.get_api_url()}/read-model/lag")
@@ -33,3 +33,11 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocations(order_id)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("restart_api", "postgres_db")
+def test_read_model_lag_is_reported():
+    r = api_client.get_read_model_lag()
+    assert r.status_code == 200
+    assert r.json()["pending"] >= 0
+    assert r.json()["lag"] >= 0
@@ -0,0 +1,168 @@
+import asyncio
+import json
+from datetime import date
+from unittest import mock
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap, views
+from allocation.adapters.orm import metadata
+from allocation.domain import commands, model
+from allocation.entrypoints import async_redis_event_consumer
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.projector import ReadModelProjector
+from tests.random_refs import random_batchref, random_orderid, random_sku
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture
+def sqlite_file(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'allocation.db'}"
+    metadata.create_all(create_engine(uri))
+    return uri
+
+
+@pytest.fixture
+def async_session_factory(sqlite_file):
+    engine = create_async_engine(
+        sqlite_file.replace("sqlite://", "sqlite+aiosqlite://")
+    )
+    yield sessionmaker(bind=engine, class_=AsyncSession)
+    asyncio.run(engine.dispose())
+
+
+def test_async_uow_can_retrieve_a_product_and_allocate_to_it(
+    async_session_factory, sqlite_file
+):
+    uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory)
+
+    async def allocate():
+        async with uow:
+            product = model.Product("HIPSTER-WORKBENCH", batches=[])
+            product.add_batch(
+                model.Batch("batch1", "HIPSTER-WORKBENCH", 100, None)
+            )
+            uow.products.add(product)
+            await uow.commit()
+        async with uow:
+            product = await uow.products.get("HIPSTER-WORKBENCH")
+            await uow.run_sync(
+                product.allocate,
+                model.OrderLine("order1", "HIPSTER-WORKBENCH", 10),
+            )
+            await uow.commit()
+
+    asyncio.run(allocate())
+
+    [[batch_ref]] = sessionmaker(bind=create_engine(sqlite_file))().execute(
+        "SELECT b.reference FROM allocations"
+        " JOIN batches AS b ON batch_id = b.id"
+    )
+    assert batch_ref == "batch1"
+
+
+def test_async_uow_rolls_back_uncommitted_work(
+    async_session_factory, sqlite_file
+):
+    uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory)
+
+    async def add_without_committing():
+        async with uow:
+            uow.products.add(model.Product("MEDIUM-PLINTH", batches=[]))
+
+    asyncio.run(add_without_committing())
+
+    rows = sessionmaker(bind=create_engine(sqlite_file))().execute(
+        "SELECT * FROM products"
+    )
+    assert list(rows) == []
+
+
+@pytest.mark.parametrize(
+    "read_model", ["handlers", "in_transaction", "projector"]
+)
+def test_async_bus_handles_messages_concurrently(
+    async_session_factory, sqlite_file, read_model
+):
+    publish = mock.AsyncMock()
+    read_uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sessionmaker(bind=create_engine(sqlite_file))
+    )
+    projector = None
+    if read_model == "projector":
+        projector = ReadModelProjector(read_uow, max_size=1000)
+    bus = bootstrap.bootstrap_async(
+        start_orm=False,
+        uow=unit_of_work.AsyncSqlAlchemyUnitOfWork(
+            async_session_factory,
+            project_read_model=read_model == "in_transaction",
+        ),
+        publish=publish,
+        notifications=mock.Mock(),
+        projector=projector,
+    )
+    skus = [random_sku(str(i)) for i in range(5)]
+    orders = [random_orderid(str(i)) for i in range(5)]
+    batch1, batch2 = random_batchref(1), random_batchref(2)
+
+    async def allocate_everything():
+        for sku in skus:
+            await bus.handle(commands.CreateBatch(batch1, sku, 10))
+            await bus.handle(
+                commands.CreateBatch(batch2, sku, 10, date.today())
+            )
+        await asyncio.gather(
+            *(
+                bus.handle(commands.Allocate(order, sku, 5))
+                for order, sku in zip(orders, skus)
+            )
+        )
+        await bus.handle(commands.ChangeBatchQuantity(batch1, skus[0], 1))
+
+    asyncio.run(allocate_everything())
+    if projector is not None:
+        assert projector.pending == len(orders) + 2
+        projector.flush()
+
+    assert views.allocations(orders[0], read_uow) == [
+        {"sku": skus[0], "batch_ref": batch2}
+    ]
+    for order, sku in zip(orders[1:], skus[1:]):
+        assert views.allocations(order, read_uow) == [
+            {"sku": sku, "batch_ref": batch1}
+        ]
+    # each allocation, and the reallocation
+    assert publish.await_count == len(orders) + 1
+
+
+def test_the_later_of_two_quantity_changes_to_a_batch_wins(
+    async_session_factory, sqlite_file
+):
+    bus = bootstrap.bootstrap_async(
+        start_orm=False,
+        uow=unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory),
+        publish=mock.AsyncMock(),
+        notifications=mock.Mock(),
+    )
+    sku, batchref = random_sku(), random_batchref()
+
+    async def arriving_together():
+        for qty in [50, 20]:
+            yield {
+                "channel": b"change_batch_quantity",
+                "data": json.dumps(dict(reference=batchref, sku=sku, qty=qty)),
+            }
+
+    async def change_quantities():
+        await bus.handle(commands.CreateBatch(batchref, sku, 100))
+        await async_redis_event_consumer.consume(arriving_together(), bus)
+
+    asyncio.run(change_quantities())
+
+    [[qty]] = sessionmaker(bind=create_engine(sqlite_file))().execute(
+        "SELECT _purchased_quantity FROM batches WHERE reference = :ref",
+        dict(ref=batchref),
+    )
+    assert qty == 20
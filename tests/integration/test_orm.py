@@ -1,6 +1,7 @@
 from datetime import date
 
 import pytest
+from allocation.adapters import orm
 from allocation.domain import model
 
 pytestmark = pytest.mark.usefixtures("mappers")
@@ -89,7 +90,7 @@ def test_allocations_mapper_can_load_allocations(in_memory_session):
         dict(oid=order_line_id, bid=batch_id),
     )
     batch = in_memory_session.query(model.Batch).filter_by(id=batch_id).first()
-    assert batch._allocations == {model.OrderLine("order1", "sku1", 10)}
+    assert set(batch._allocations) == {model.OrderLine("order1", "sku1", 10)}
 
 
 def test_allocations_mapper_can_save_allocations(in_memory_session):
@@ -102,3 +103,71 @@ def test_allocations_mapper_can_save_allocations(in_memory_session):
         "SELECT order_line_id, batch_id FROM allocations"
     )
     assert list(rows) == [(line.id, batch.id)]
+
+
+def test_batches_mapper_saves_the_allocated_quantity(in_memory_session):
+    batch = model.Batch("batch1", "sku1", 100, eta=None)
+    batch.allocate(model.OrderLine("order1", "sku1", 10))
+    batch.allocate(model.OrderLine("order2", "sku1", 15))
+    in_memory_session.add(batch)
+    in_memory_session.commit()
+    batch.deallocate_one()
+    in_memory_session.commit()
+
+    [[allocated]] = in_memory_session.execute(
+        "SELECT _allocated_quantity FROM batches"
+    )
+    assert allocated == batch.allocated_quantity
+    assert allocated in (10, 15)
+
+
+def test_allocated_quantities_can_be_reconciled(in_memory_session):
+    batch = model.Batch("batch1", "sku1", 100, eta=None)
+    batch.allocate(model.OrderLine("order1", "sku1", 10))
+    batch.allocate(model.OrderLine("order2", "sku1", 15))
+    in_memory_session.add(batch)
+    in_memory_session.commit()
+    in_memory_session.execute(
+        "INSERT INTO order_lines (order_id, sku, qty) VALUES"
+        '("order3", "sku1", 5)'
+    )
+    in_memory_session.execute(
+        "INSERT INTO allocations (order_line_id, batch_id)"
+        " SELECT id, :bid FROM order_lines WHERE order_id='order3'",
+        dict(bid=batch.id),
+    )
+
+    orm.reconcile_allocated_quantities(in_memory_session)
+    in_memory_session.expire_all()
+
+    assert batch.allocated_quantity == 30
+    assert batch.available_quantity == 70
+
+
+def test_mappers_intern_loaded_skus(in_memory_session):
+    in_memory_session.execute(
+        "INSERT INTO order_lines (order_id, sku, qty) VALUES"
+        '("order1", "RED-RIBBON", 10),'
+        '("order2", "RED-RIBBON", 11)'
+    )
+
+    line1, line2 = in_memory_session.query(model.OrderLine).all()
+
+    assert line1.sku is line2.sku
+    assert not in_memory_session.dirty
+
+
+def test_products_forget_their_indexes_when_expired(in_memory_session):
+    product = model.Product(
+        "SMALL-TABLE", [model.Batch("batch1", "SMALL-TABLE", 10, None)]
+    )
+    in_memory_session.add(product)
+    in_memory_session.commit()
+    product.allocate(model.OrderLine("order1", "SMALL-TABLE", 10))
+
+    in_memory_session.rollback()
+
+    assert product._batch_order is None
+    assert product.allocate(model.OrderLine("order2", "SMALL-TABLE", 10)) == (
+        "batch1"
+    )
@@ -0,0 +1,144 @@
+from collections import deque
+import logging
+import time
+from unittest import mock
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap, views
+from allocation.adapters.orm import metadata
+from allocation.domain import commands, events
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.projector import ReadModelProjector
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+def view_rows(session_factory):
+    return sorted(
+        session_factory().execute(
+            "SELECT order_id, sku, batch_ref FROM allocations_view"
+        )
+    )
+
+
+def test_buffers_events_until_the_batch_is_full(in_memory_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(in_memory_session_factory)
+    projector = ReadModelProjector(uow, max_size=3, max_delay=60)
+
+    projector.handle(events.Allocated("o1", "LAMP", 1, "b1"))
+    projector.handle(events.Allocated("o2", "LAMP", 1, "b1"))
+    assert view_rows(in_memory_session_factory) == []
+    assert projector.pending == 2
+    assert projector.lag > 0
+
+    projector.handle(events.Allocated("o3", "CHAIR", 1, "b2"))
+
+    assert view_rows(in_memory_session_factory) == [
+        ("o1", "LAMP", "b1"),
+        ("o2", "LAMP", "b1"),
+        ("o3", "CHAIR", "b2"),
+    ]
+    assert projector.pending == 0
+    assert projector.lag == 0
+
+
+def test_keeps_each_orders_events_in_order(in_memory_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(in_memory_session_factory)
+    projector = ReadModelProjector(uow, max_size=100)
+    projector.handle(events.Allocated("o1", "LAMP", 1, "b1"))
+    projector.handle(events.Allocated("o2", "LAMP", 1, "b1"))
+    projector.flush()
+
+    for event in [
+        events.Deallocated("o1", "LAMP", 1),
+        events.Allocated("o1", "LAMP", 1, "b2"),
+        events.Allocated("o3", "LAMP", 1, "b1"),
+        events.Deallocated("o3", "LAMP", 1),
+        events.Deallocated("o2", "LAMP", 1),
+    ]:
+        projector.handle(event)
+    projector.flush()
+
+    assert view_rows(in_memory_session_factory) == [("o1", "LAMP", "b2")]
+
+
+def test_logs_how_far_behind_each_flush_was(in_memory_session_factory, caplog):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(in_memory_session_factory)
+    projector = ReadModelProjector(uow, max_delay=60)
+    projector.handle(events.Allocated("o1", "LAMP", 1, "b1"))
+    projector.handle(events.Allocated("o2", "LAMP", 1, "b1"))
+
+    with caplog.at_level(logging.INFO, "allocation.service_layer.projector"):
+        projector.flush()
+
+    [message] = caplog.messages
+    assert message.startswith("Applied 2 read model events")
+    assert "0 more buffered since" in message
+
+
+def test_only_flushes_once_due(in_memory_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(in_memory_session_factory)
+    waiting = ReadModelProjector(uow, max_delay=60)
+    due = ReadModelProjector(uow, max_delay=0)
+    waiting.handle(events.Allocated("o1", "LAMP", 1, "b1"))
+    due.handle(events.Allocated("o2", "LAMP", 1, "b1"))
+
+    waiting.flush_if_due()
+    due.flush_if_due()
+
+    assert view_rows(in_memory_session_factory) == [("o2", "LAMP", "b1")]
+
+
+def test_flushes_in_the_background_once_due(tmp_path):
+    # a file, since each thread gets its own in-memory database
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    projector = ReadModelProjector(uow, max_delay=0.05, background=True)
+
+    projector.handle(events.Allocated("o1", "LAMP", 1, "b1"))
+
+    deadline = time.monotonic() + 5
+    while not view_rows(session_factory) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert view_rows(session_factory) == [("o1", "LAMP", "b1")]
+    assert projector.pending == 0
+
+
+def test_keeps_events_that_failed_to_apply(in_memory_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(in_memory_session_factory)
+    projector = ReadModelProjector(uow)
+    projector.handle(events.Allocated("o1", "LAMP", 1, "b1"))
+
+    with mock.patch.object(uow, "commit", side_effect=IOError):
+        with pytest.raises(IOError):
+            projector.flush()
+    assert projector.pending == 1
+
+    projector.flush()
+    assert view_rows(in_memory_session_factory) == [("o1", "LAMP", "b1")]
+
+
+def test_bus_projects_through_the_projector(in_memory_session_factory):
+    projector = ReadModelProjector(
+        unit_of_work.SqlAlchemyUnitOfWork(in_memory_session_factory),
+        max_delay=0,
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(in_memory_session_factory),
+        message_queue_factory=deque,
+        publish=lambda *args, **kwargs: None,
+        notifications=mock.Mock(),
+        projector=projector,
+    )
+    bus.handle(commands.CreateBatch("b1", "LAMP", 100, None))
+
+    bus.handle(commands.Allocate("o1", "LAMP", 10))
+
+    assert projector.pending == 0
+    assert views.allocations("o1", bus.read_uow) == [
+        {"sku": "LAMP", "batch_ref": "b1"}
+    ]
@@ -0,0 +1,219 @@
+from typing import List
+from unittest import mock
+import pytest
+from sqlalchemy import event, false
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import clear_mappers
+from allocation.adapters import orm, repository
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def lazy_mappers():
+    orm.start_mappers(loading_strategy="select")
+    yield
+    clear_mappers()
+
+
+@pytest.fixture
+def count_queries(in_memory_db):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(in_memory_db, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(in_memory_db, "before_cursor_execute", before_cursor_execute)
+
+
+def add_product(session, sku: str, batches: int, lines_per_batch: int):
+    product = model.Product(sku, [])
+    for b in range(batches):
+        batch = model.Batch(f"{sku}-batch{b}", sku, 1000, eta=None)
+        for l in range(lines_per_batch):
+            batch.allocate(model.OrderLine(f"order{b}-{l}", sku, 1))
+        product.add_batch(batch)
+    session.add(product)
+    session.commit()
+
+
+def load_product(session_factory, sku: str, **kwargs):
+    session = session_factory()
+    return repository.SqlAlchemyRepository(session, **kwargs).get(sku)
+
+
+def loads_allocations(statements: List[str]) -> bool:
+    return any("allocations" in statement for statement in statements)
+
+
+@pytest.mark.usefixtures("mappers")
+@pytest.mark.parametrize("batches", [1, 10])
+def test_loading_a_product_takes_a_fixed_number_of_queries(
+    in_memory_session_factory, count_queries, batches
+):
+    add_product(in_memory_session_factory(), "LAMP", batches, 3)
+    count_queries.clear()
+
+    product = load_product(in_memory_session_factory, "LAMP")
+    available = [b.available_quantity for b in product.batches]
+
+    assert available == [997] * batches
+    assert len(count_queries) == 2
+    assert not loads_allocations(count_queries)
+
+
+@pytest.mark.usefixtures("lazy_mappers")
+def test_checking_availability_does_not_load_allocations(
+    in_memory_session_factory, count_queries
+):
+    add_product(in_memory_session_factory(), "LAMP", 10, 3)
+    count_queries.clear()
+    repo = repository.SqlAlchemyRepository(in_memory_session_factory())
+
+    product = repo.get("LAMP")
+    available = [b.available_quantity for b in product.batches]
+
+    assert available == [997] * 10
+    assert len(count_queries) == 2
+    assert not loads_allocations(count_queries)
+
+
+@pytest.mark.usefixtures("lazy_mappers")
+@pytest.mark.parametrize("strategy", ["selectin", "joined", "subquery"])
+def test_repository_can_override_the_loading_strategy(
+    in_memory_session_factory, count_queries, strategy
+):
+    add_product(in_memory_session_factory(), "LAMP", 10, 3)
+    count_queries.clear()
+
+    product = load_product(
+        in_memory_session_factory, "LAMP", loading_strategy=strategy
+    )
+
+    assert sum(b.available_quantity for b in product.batches) == 9970
+    assert len(count_queries) <= 2
+    assert not loads_allocations(count_queries)
+
+
+@pytest.mark.usefixtures("mappers")
+def test_allocating_only_looks_up_the_line_being_allocated(
+    in_memory_session_factory, count_queries
+):
+    add_product(in_memory_session_factory(), "LAMP", 1, 100)
+    session = in_memory_session_factory()
+    product = repository.SqlAlchemyRepository(session).get("LAMP")
+    [batch] = product.batches
+    count_queries.clear()
+
+    product.allocate(model.OrderLine("order0-0", "LAMP", 1))
+    product.allocate(model.OrderLine("new-order", "LAMP", 1))
+    product.allocate(model.OrderLine("new-order", "LAMP", 1))
+
+    # one lookup for each line that isn't already waiting to be saved
+    assert len(count_queries) == 2
+    assert batch.available_quantity == 899
+    session.commit()
+    assert len(batch._allocations) == 101
+
+
+def test_product_cache_evicts_least_recently_used_products():
+    cache = repository.ProductCache(max_size=2)
+    lamp, chair, table = (
+        model.Product(sku, []) for sku in ["LAMP", "CHAIR", "TABLE"]
+    )
+    cache.put([lamp, chair])
+    cache.put([cache.checkout("LAMP")])
+
+    cache.put([table])
+
+    assert len(cache) == 2
+    assert cache.checkout("CHAIR") is None
+    assert cache.checkout("LAMP") is lamp
+
+
+@pytest.mark.usefixtures("mappers")
+def test_get_many_fetches_products_in_a_fixed_number_of_queries(
+    in_memory_session_factory, count_queries
+):
+    skus = [f"LAMP-{i}" for i in range(20)]
+    for sku in skus:
+        add_product(in_memory_session_factory(), sku, 2, 3)
+    count_queries.clear()
+    repo = repository.SqlAlchemyRepository(in_memory_session_factory())
+
+    products = repo.get_many(skus + ["NO-SUCH-SKU"])
+
+    assert sorted(products) == sorted(skus)
+    assert repo.seen == set(products.values())
+    assert all(p.batches[1].allocated_quantity == 3 for p in products.values())
+    assert len(count_queries) == 2
+    assert not loads_allocations(count_queries)
+
+
+@pytest.mark.usefixtures("mappers")
+def test_get_many_reuses_cached_products(in_memory_session_factory):
+    add_product(in_memory_session_factory(), "LAMP", 1, 1)
+    add_product(in_memory_session_factory(), "CHAIR", 1, 1)
+    cache = repository.ProductCache()
+    session = in_memory_session_factory()
+    lamp = repository.SqlAlchemyRepository(session).get("LAMP")
+    session.close()
+    cache.put([lamp])
+
+    repo = repository.SqlAlchemyRepository(
+        in_memory_session_factory(), cache=cache
+    )
+    products = repo.get_many(["LAMP", "CHAIR"])
+
+    assert products["LAMP"] is lamp
+    assert products["CHAIR"].sku == "CHAIR"
+
+
+@pytest.mark.usefixtures("mappers")
+@pytest.mark.parametrize(
+    "lock_mode, clause",
+    [
+        ("update", "FOR UPDATE OF products"),
+        ("nowait", "FOR UPDATE OF products NOWAIT"),
+        ("skip_locked", "FOR UPDATE OF products SKIP LOCKED"),
+    ],
+)
+def test_lock_modes_lock_only_the_products_rows(
+    in_memory_session, lock_mode, clause
+):
+    repo = repository.SqlAlchemyRepository(
+        in_memory_session, lock_mode=lock_mode
+    )
+
+    query = repo._query().filter_by(sku="LAMP")
+    sql = str(query.statement.compile(dialect=postgresql.dialect()))
+
+    assert sql.endswith(clause)
+
+
+@pytest.mark.usefixtures("mappers")
+def test_skipping_a_locked_product_is_a_concurrency_conflict(
+    in_memory_session,
+):
+    in_memory_session.add(model.Product("LAMP", []))
+    in_memory_session.commit()
+    repo = repository.SqlAlchemyRepository(
+        in_memory_session, lock_mode="skip_locked"
+    )
+    # what SKIP LOCKED would return were another transaction holding it
+    skipped = in_memory_session.query(model.Product).filter(false())
+
+    with mock.patch.object(repo, "_query", return_value=skipped):
+        with pytest.raises(repository.ProductLocked) as locked:
+            repo.get("LAMP")
+        assert repo.get_many(["CHAIR"]) == {}
+        with pytest.raises(repository.ProductLocked):
+            repo.get_many(["LAMP", "CHAIR"])
+    assert unit_of_work.is_concurrency_conflict(locked.value)
+
+
+def test_unknown_lock_modes_are_rejected(in_memory_session):
+    with pytest.raises(ValueError):
+        repository.SqlAlchemyRepository(in_memory_session, lock_mode="share")
@@ -0,0 +1,113 @@
+import pytest
+from sqlalchemy import create_engine, inspect
+from allocation.adapters import orm, schema
+
+# the tables as they were before any indexes or the allocated quantity column
+OLD_SCHEMA = [
+    "CREATE TABLE order_lines (id INTEGER PRIMARY KEY, sku VARCHAR(255)"
+    " NOT NULL, qty INTEGER NOT NULL, order_id VARCHAR(255) NOT NULL)",
+    "CREATE TABLE products (sku VARCHAR(255) PRIMARY KEY,"
+    " version_number INTEGER DEFAULT 0 NOT NULL)",
+    "CREATE TABLE batches (id INTEGER PRIMARY KEY, reference VARCHAR(255)"
+    " NOT NULL, sku VARCHAR(255) REFERENCES products (sku),"
+    " _purchased_quantity INTEGER NOT NULL, eta DATE)",
+    "CREATE TABLE allocations (id INTEGER PRIMARY KEY, order_line_id"
+    " INTEGER REFERENCES order_lines (id), batch_id INTEGER"
+    " REFERENCES batches (id))",
+]
+
+
+def old_database(extra_rows=()):
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        for statement in OLD_SCHEMA:
+            connection.execute(statement)
+        connection.execute(
+            "INSERT INTO products (sku, version_number) VALUES ('LAMP', 1)"
+        )
+        connection.execute(
+            "INSERT INTO batches (id, reference, sku, _purchased_quantity)"
+            " VALUES (1, 'batch1', 'LAMP', 100)"
+        )
+        connection.execute(
+            "INSERT INTO order_lines (id, sku, qty, order_id)"
+            " VALUES (1, 'LAMP', 10, 'order1'), (2, 'LAMP', 5, 'order2')"
+        )
+        connection.execute(
+            "INSERT INTO allocations (order_line_id, batch_id)"
+            " VALUES (1, 1), (2, 1)"
+        )
+        for statement in extra_rows:
+            connection.execute(statement)
+    return engine
+
+
+def test_upgrade_brings_an_old_database_up_to_date():
+    engine = old_database()
+
+    schema.upgrade(engine)
+
+    inspector = inspect(engine)
+    for table in orm.metadata.sorted_tables:
+        indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+        assert indexes == {i.name for i in table.indexes}
+    [[allocated]] = engine.execute("SELECT _allocated_quantity FROM batches")
+    assert allocated == 15
+
+
+def test_upgrade_can_run_again():
+    engine = old_database()
+    schema.upgrade(engine)
+
+    schema.upgrade(engine)
+
+    [[count]] = engine.execute("SELECT COUNT(*) FROM batches")
+    assert count == 1
+
+
+def test_upgrade_removes_repeated_allocations():
+    engine = old_database(
+        ["INSERT INTO allocations (order_line_id, batch_id) VALUES (1, 1)"]
+    )
+
+    schema.upgrade(engine)
+
+    [[count]] = engine.execute("SELECT COUNT(*) FROM allocations")
+    assert count == 2
+    [[allocated]] = engine.execute("SELECT _allocated_quantity FROM batches")
+    assert allocated == 15
+
+
+def test_upgrade_reports_duplicate_batches_and_changes_nothing():
+    engine = old_database(
+        [
+            "INSERT INTO batches (id, reference, sku, _purchased_quantity)"
+            " VALUES (2, 'batch1', 'LAMP', 50)"
+        ]
+    )
+
+    with pytest.raises(schema.DuplicateRows, match="'LAMP', 'batch1'"):
+        schema.upgrade(engine)
+
+    inspector = inspect(engine)
+    assert "_allocated_quantity" not in {
+        c["name"] for c in inspector.get_columns("batches")
+    }
+    assert inspector.get_indexes("allocations") == []
+    engine.execute("UPDATE batches SET reference = 'batch2' WHERE id = 2")
+    schema.upgrade(engine)
+
+
+def test_read_model_queries_use_an_index():
+    engine = create_engine("sqlite://")
+    schema.upgrade(engine)
+
+    for query in [
+        "SELECT sku, batch_ref FROM allocations_view WHERE order_id = 'o1'",
+        "DELETE FROM allocations_view WHERE sku = 's1' AND order_id = 'o1'",
+    ]:
+        plan = " ".join(
+            str(row[-1])
+            for row in engine.execute(f"EXPLAIN QUERY PLAN {query}")
+        )
+        assert "ix_allocations_view_order_id_sku" in plan
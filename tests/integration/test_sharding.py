@@ -0,0 +1,90 @@
+from collections import deque
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap, views
+from allocation.adapters import orm
+from allocation.adapters.notifications import AbstractNotifications
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+class NoNotifications(AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
+@pytest.fixture
+def shard_session_factories():
+    factories = []
+    for _ in range(3):
+        engine = create_engine("sqlite://")
+        orm.metadata.create_all(engine)
+        factories.append(sessionmaker(bind=engine))
+    return factories
+
+
+def skus_on_every_shard(shards: int):
+    skus = {}
+    i = 0
+    while len(skus) < shards:
+        sku = f"SHARDED-LAMP-{i}"
+        skus.setdefault(unit_of_work.shard_for(sku, shards), sku)
+        i += 1
+    return [skus[shard] for shard in range(shards)]
+
+
+def bootstrap_sharded(session_factories):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.ShardedSqlAlchemyUnitOfWork(session_factories),
+        notifications=NoNotifications(),
+        message_queue_factory=deque,
+        publish=lambda *args, **kwargs: None,
+    )
+
+
+def test_shards_are_stable():
+    assert unit_of_work.shard_for("RED-CHAIR", 4) == 1
+    assert unit_of_work.shard_for("BLUE-VASE", 4) == 2
+
+
+def test_products_live_on_the_shard_of_their_sku(shard_session_factories):
+    bus = bootstrap_sharded(shard_session_factories)
+    skus = skus_on_every_shard(3)
+
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 100, None))
+
+    for shard, session_factory in enumerate(shard_session_factories):
+        rows = session_factory().execute("SELECT sku FROM products")
+        assert [sku for sku, in rows] == [skus[shard]]
+
+
+def test_views_fan_out_across_shards(shard_session_factories):
+    bus = bootstrap_sharded(shard_session_factories)
+    skus = skus_on_every_shard(3)
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 100, None))
+
+    for sku in skus:
+        bus.handle(commands.Allocate("order1", sku, 10))
+
+    assert sorted(views.allocations("order1", bus.uow), key=str) == sorted(
+        [dict(sku=sku, batch_ref=f"{sku}-batch") for sku in skus], key=str
+    )
+
+
+def test_get_many_reaches_every_shard(shard_session_factories):
+    bus = bootstrap_sharded(shard_session_factories)
+    skus = skus_on_every_shard(3)
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 100, None))
+
+    with bus.uow:
+        products = bus.uow.products.get_many(skus + ["NO-SUCH-SKU"])
+
+        assert sorted(products) == sorted(skus)
+        assert len(bus.uow.sessions) == 3
@@ -1,9 +1,17 @@
+from collections import deque
 from typing import Optional, List
 from datetime import date
+import threading
 import time
 import traceback
+from unittest import mock
 import pytest
-from allocation.domain import model
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+from allocation import bootstrap
+from allocation.adapters import orm, repository
+from allocation.domain import commands, model
 from allocation.service_layer import unit_of_work
 from tests.random_refs import random_batchref, random_sku, random_orderid
 
@@ -142,3 +150,335 @@ def test_concurrent_updates_to_version_are_not_allowed(pg_session_factory):
         dict(sku=sku),
     )
     assert len(list(orders)) == 1
+
+
+def allocate_with(uow, order_id, sku, qty=10):
+    with uow:
+        product = uow.products.get(sku=sku)
+        product.allocate(model.OrderLine(order_id, sku, qty))
+        uow.commit()
+    list(uow.collect_new_events())
+    return product
+
+
+def test_uow_reuses_cached_products(in_memory_session_factory):
+    session = in_memory_session_factory()
+    insert_batch(session, "batch1", "SIMPLE-CHAIR", 100, None)
+    session.commit()
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        in_memory_session_factory, product_cache=cache
+    )
+
+    first = allocate_with(uow, "order1", "SIMPLE-CHAIR")
+    second = allocate_with(uow, "order2", "SIMPLE-CHAIR")
+
+    assert second is first
+    assert second.batches[0].available_quantity == 80
+    assert get_allocated_batch_ref(session, "order2", "SIMPLE-CHAIR") == (
+        "batch1"
+    )
+
+
+def test_uow_reloads_products_changed_elsewhere(in_memory_session_factory):
+    session = in_memory_session_factory()
+    insert_batch(session, "batch1", "SIMPLE-CHAIR", 100, None)
+    session.commit()
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        in_memory_session_factory, product_cache=cache
+    )
+    first = allocate_with(uow, "order1", "SIMPLE-CHAIR")
+
+    session.execute(
+        "UPDATE products SET version_number = version_number + 1"
+        " WHERE sku='SIMPLE-CHAIR'"
+    )
+    session.execute("UPDATE batches SET _purchased_quantity = 50")
+    session.commit()
+    second = allocate_with(uow, "order2", "SIMPLE-CHAIR")
+
+    assert second is not first
+    assert second.batches[0].available_quantity == 30
+
+
+def test_uow_does_not_cache_uncommitted_products(in_memory_session_factory):
+    session = in_memory_session_factory()
+    insert_batch(session, "batch1", "SIMPLE-CHAIR", 100, None)
+    session.commit()
+    cache = repository.ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        in_memory_session_factory, product_cache=cache
+    )
+    allocate_with(uow, "order1", "SIMPLE-CHAIR")
+
+    with uow:
+        product = uow.products.get(sku="SIMPLE-CHAIR")
+        product.allocate(model.OrderLine("order2", "SIMPLE-CHAIR", 10))
+    list(uow.collect_new_events())
+
+    assert len(cache) == 0
+
+
+def test_stale_product_versions_are_detected(in_memory_session_factory):
+    session = in_memory_session_factory()
+    insert_batch(session, "batch1", "SIMPLE-CHAIR", 100, None)
+    session.commit()
+    uow1 = unit_of_work.SqlAlchemyUnitOfWork(in_memory_session_factory)
+    uow2 = unit_of_work.SqlAlchemyUnitOfWork(in_memory_session_factory)
+
+    with uow1, uow2:
+        uow1.products.get(sku="SIMPLE-CHAIR").allocate(
+            model.OrderLine("order1", "SIMPLE-CHAIR", 10)
+        )
+        uow2.products.get(sku="SIMPLE-CHAIR").allocate(
+            model.OrderLine("order2", "SIMPLE-CHAIR", 10)
+        )
+        uow1.commit()
+        with pytest.raises(Exception) as conflict:
+            uow2.commit()
+
+    assert unit_of_work.is_concurrency_conflict(conflict.value)
+    assert get_allocated_batch_ref(session, "order1", "SIMPLE-CHAIR") == (
+        "batch1"
+    )
+
+
+def allocate_slowly_with_lock(session_factory, orderid, sku, exceptions):
+    line = model.OrderLine(orderid, sku, 10)
+    try:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(
+            session_factory, lock_mode="update"
+        )
+        with uow:
+            product = uow.products.get(sku=sku)
+            product.allocate(line)
+            time.sleep(1)
+            uow.commit()
+    except Exception as e:
+        print(traceback.format_exc())
+        exceptions.append(e)
+
+
+def test_locked_updates_wait_for_each_other(pg_session_factory):
+    # pg_session_factory is READ COMMITTED, the isolation level locking
+    # deployments run at
+    sku, batch = random_sku(), random_batchref()
+    session = pg_session_factory()
+    insert_batch(session, batch, sku, 100, eta=None, product_version=1)
+    session.commit()
+
+    exceptions = []  # type: List[Exception]
+    with futures.ThreadPoolExecutor(2) as executor:
+        for orderid in [random_orderid(1), random_orderid(2)]:
+            executor.submit(
+                allocate_slowly_with_lock,
+                pg_session_factory,
+                orderid,
+                sku,
+                exceptions,
+            )
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku=:sku",
+        dict(sku=sku),
+    )
+    assert version == 3
+    assert exceptions == []
+
+
+def test_uow_can_lock_products_it_reads(in_memory_session_factory):
+    session = in_memory_session_factory()
+    insert_batch(session, "batch1", "SIMPLE-CHAIR", 100, None)
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        in_memory_session_factory,
+        product_cache=repository.ProductCache(),
+        lock_mode="nowait",
+    )
+
+    allocate_with(uow, "order1", "SIMPLE-CHAIR")
+    allocate_with(uow, "order2", "SIMPLE-CHAIR")
+
+    assert get_allocated_batch_ref(session, "order2", "SIMPLE-CHAIR") == (
+        "batch1"
+    )
+
+
+def test_scoped_uow_keeps_products_between_commits(in_memory_session_factory):
+    session = in_memory_session_factory()
+    insert_batch(session, "batch1", "SIMPLE-CHAIR", 100, None)
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        in_memory_session_factory, scoped=True
+    )
+
+    with uow.scope():
+        first = allocate_with(uow, "order1", "SIMPLE-CHAIR")
+        second = allocate_with(uow, "order2", "SIMPLE-CHAIR")
+
+    assert second is first
+    assert second.batches[0].available_quantity == 80
+    assert get_allocated_batch_ref(session, "order2", "SIMPLE-CHAIR") == (
+        "batch1"
+    )
+
+
+def test_scoped_uow_reloads_products_after_a_rollback(
+    in_memory_session_factory,
+):
+    session = in_memory_session_factory()
+    insert_batch(session, "batch1", "SIMPLE-CHAIR", 100, None)
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        in_memory_session_factory, scoped=True
+    )
+
+    with uow.scope():
+        with uow:
+            product = uow.products.get(sku="SIMPLE-CHAIR")
+            product.allocate(model.OrderLine("order1", "SIMPLE-CHAIR", 10))
+        product = allocate_with(uow, "order2", "SIMPLE-CHAIR")
+
+    assert product.batches[0].available_quantity == 90
+
+
+@pytest.mark.parametrize("scoped, product_queries", [(False, 9), (True, 1)])
+def test_scoped_uow_loads_each_product_once_per_message(
+    in_memory_db, scoped, product_queries
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sessionmaker(bind=in_memory_db), scoped=scoped
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        message_queue_factory=deque,
+        publish=lambda *args, **kwargs: None,
+        notifications=mock.Mock(),
+    )
+    sku = random_sku()
+    batch1, batch2 = random_batchref(1), random_batchref(2)
+    bus.handle(commands.CreateBatch(batch1, sku, 100, None))
+    bus.handle(commands.CreateBatch(batch2, sku, 100, date.today()))
+    for order in range(4):
+        bus.handle(commands.Allocate(f"order{order}", sku, 20))
+    queries = []
+
+    def count_product_query(conn, cursor, statement, *args):
+        if statement.startswith("SELECT products."):
+            queries.append(statement)
+
+    event.listen(in_memory_db, "before_cursor_execute", count_product_query)
+    try:
+        bus.handle(commands.ChangeBatchQuantity(batch1, sku, 10))
+    finally:
+        event.remove(
+            in_memory_db, "before_cursor_execute", count_product_query
+        )
+
+    assert len(queries) == product_queries
+    with uow:
+        [batch] = [
+            b for b in uow.products.get(sku).batches if b.reference == batch2
+        ]
+        assert batch.available_quantity == 20
+
+
+def test_thread_local_uow_gives_each_thread_its_own(in_memory_session_factory):
+    uow = unit_of_work.ThreadLocalUnitOfWork(
+        lambda: unit_of_work.SqlAlchemyUnitOfWork(in_memory_session_factory)
+    )
+    current = {}
+
+    def use_uow(name):
+        with uow:
+            current[name] = (uow.current, uow.session)
+
+    threads = [threading.Thread(target=use_uow, args=(name,)) for name in "ab"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    use_uow("main")
+
+    assert len({id(uow) for uow, _ in current.values()}) == 3
+    assert len({id(session) for _, session in current.values()}) == 3
+
+
+def test_bus_can_handle_messages_from_several_threads(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'allocation.db'}",
+        connect_args={"timeout": 30},
+    )
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.ThreadLocalUnitOfWork(
+            lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        ),
+        message_queue_factory=deque,
+        publish=lambda *args, **kwargs: None,
+        notifications=mock.Mock(),
+    )
+    skus = [random_sku(str(i)) for i in range(8)]
+    for sku in skus:
+        bus.handle(commands.CreateBatch(random_batchref(), sku, 100, None))
+    errors = []
+
+    def allocate(sku):
+        try:
+            for i in range(5):
+                bus.handle(commands.Allocate(f"order{i}", sku, 10))
+        except Exception as e:
+            errors.append(e)
+
+    with futures.ThreadPoolExecutor(len(skus)) as executor:
+        list(executor.map(allocate, skus))
+
+    assert errors == []
+    session = session_factory()
+    for sku in skus:
+        [[allocated]] = session.execute(
+            "SELECT _allocated_quantity FROM batches WHERE sku=:sku",
+            dict(sku=sku),
+        )
+        assert allocated == 50
+
+
+@pytest.mark.parametrize("scoped", [False, True])
+def test_retried_commands_only_raise_the_events_of_the_last_attempt(
+    in_memory_db, monkeypatch, scoped
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sessionmaker(bind=in_memory_db), scoped=scoped
+    )
+    published = []
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        message_queue_factory=deque,
+        publish=lambda channel, event: published.append(event),
+        notifications=mock.Mock(),
+    )
+    sku, early, late = random_sku(), random_batchref(1), random_batchref(2)
+    bus.handle(commands.CreateBatch(early, sku, 10, None))
+    bus.handle(commands.CreateBatch(late, sku, 10, date.today()))
+    commit, attempts = uow._commit, []
+
+    def commit_after_losing_a_race():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise StaleDataError("version changed")
+        commit()
+
+    monkeypatch.setattr(uow, "_commit", commit_after_losing_a_race)
+    bus.handle(commands.Allocate("order1", sku, 10))
+
+    assert [event.batch_ref for event in published] == [early]
+    session = sessionmaker(bind=in_memory_db)()
+    assert get_allocated_batch_ref(session, "order1", sku) == early
+    assert list(session.execute("SELECT batch_ref FROM allocations_view")) == [
+        (early,)
+    ]
@@ -3,7 +3,8 @@ import pytest
 from unittest import mock
 from collections import deque
 
-from sqlalchemy.orm import clear_mappers
+from sqlalchemy import event
+from sqlalchemy.orm import clear_mappers, sessionmaker
 from allocation import views
 from allocation import bootstrap
 from allocation.domain import commands
@@ -63,3 +64,80 @@ def test_deallocation(message_bus):
     assert views.allocations(order, message_bus.uow) == [
         {"sku": sku, "batch_ref": batch2},
     ]
+
+
+def test_views_can_read_through_a_read_only_uow(in_memory_db):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=in_memory_db))
+    read_uow = unit_of_work.ReadOnlyUnitOfWork(
+        sessionmaker(
+            bind=in_memory_db.execution_options(isolation_level="AUTOCOMMIT")
+        )
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=uow,
+        read_uow=read_uow,
+        message_queue_factory=deque,
+        publish=lambda *args, **kwargs: None,
+        notifications=mock.Mock(),
+    )
+    try:
+        batch, sku, order = random_batchref(), random_sku(), random_orderid()
+        bus.handle(commands.CreateBatch(batch, sku, 50, None))
+        bus.handle(commands.Allocate(order, sku, 20))
+
+        assert bus.read_uow is read_uow
+        assert views.allocations(order, bus.read_uow) == [
+            {"sku": sku, "batch_ref": batch},
+        ]
+        with pytest.raises(unit_of_work.ReadOnlyWorkError), read_uow:
+            read_uow.commit()
+    finally:
+        clear_mappers()
+
+
+@pytest.mark.parametrize(
+    "project_read_model, commits", [(False, 2), (True, 1)]
+)
+def test_read_model_can_be_written_in_the_same_transaction(
+    in_memory_db, project_read_model, commits
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sessionmaker(bind=in_memory_db),
+        project_read_model=project_read_model,
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=uow,
+        message_queue_factory=deque,
+        publish=lambda *args, **kwargs: None,
+        notifications=mock.Mock(),
+    )
+    committed = []
+
+    def count_commit(connection):
+        committed.append(connection)
+
+    event.listen(in_memory_db, "commit", count_commit)
+    try:
+        batch1, batch2 = random_batchref(1), random_batchref(2)
+        sku, order = random_sku(), random_orderid()
+        bus.handle(commands.CreateBatch(batch1, sku, 50, None))
+        bus.handle(commands.CreateBatch(batch2, sku, 50, today))
+        committed.clear()
+
+        bus.handle(commands.Allocate(order, sku, 40))
+
+        assert len(committed) == commits
+        assert views.allocations(order, bus.uow) == [
+            {"sku": sku, "batch_ref": batch1},
+        ]
+
+        bus.handle(commands.ChangeBatchQuantity(batch1, sku, 10))
+
+        assert views.allocations(order, bus.uow) == [
+            {"sku": sku, "batch_ref": batch2},
+        ]
+    finally:
+        event.remove(in_memory_db, "commit", count_commit)
+        clear_mappers()
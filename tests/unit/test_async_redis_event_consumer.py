@@ -0,0 +1,58 @@
+import asyncio
+import json
+from allocation.domain import commands
+from allocation.entrypoints import async_redis_event_consumer
+
+
+class SlowFirstBus:
+    """Takes longer over the first command it's given than the rest."""
+
+    def __init__(self) -> None:
+        self.handled = []
+        self._first = True
+
+    async def handle(self, command):
+        first, self._first = self._first, False
+        if first:
+            await asyncio.sleep(0.05)
+        self.handled.append(command)
+
+
+def change_quantity(reference, sku, qty):
+    return {
+        "channel": b"change_batch_quantity",
+        "data": json.dumps(dict(reference=reference, sku=sku, qty=qty)),
+    }
+
+
+async def arriving(*messages):
+    for message in messages:
+        yield message
+
+
+def consume(*messages):
+    bus = SlowFirstBus()
+    asyncio.run(async_redis_event_consumer.consume(arriving(*messages), bus))
+    return bus.handled
+
+
+def test_messages_for_one_sku_are_handled_in_the_order_they_arrived():
+    handled = consume(
+        change_quantity("b1", "LAMP", 50), change_quantity("b1", "LAMP", 20)
+    )
+
+    assert handled == [
+        commands.ChangeBatchQuantity("b1", "LAMP", 50),
+        commands.ChangeBatchQuantity("b1", "LAMP", 20),
+    ]
+
+
+def test_messages_for_other_skus_dont_wait_for_them():
+    handled = consume(
+        change_quantity("b1", "LAMP", 50), change_quantity("b2", "TABLE", 20)
+    )
+
+    assert handled == [
+        commands.ChangeBatchQuantity("b2", "TABLE", 20),
+        commands.ChangeBatchQuantity("b1", "LAMP", 50),
+    ]
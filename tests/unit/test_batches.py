@@ -44,3 +44,40 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+
+def test_deallocating_restores_the_available_quantity():
+    batch, line = make_batch_and_line("ROUND-TABLE", 20, 2)
+    batch.allocate(line)
+    assert batch.deallocate_one() == line
+    assert batch.allocated_quantity == 0
+    assert batch.available_quantity == 20
+
+
+def test_deallocating_lines_restores_their_quantity():
+    batch = Batch("batch-001", "ROUND-TABLE", qty=20, eta=date.today())
+    lines = [OrderLine(f"order-{i}", "ROUND-TABLE", qty=i) for i in (1, 2, 3)]
+    for line in lines:
+        batch.allocate(line)
+
+    batch.deallocate(lines[1:])
+
+    assert batch._allocations == {lines[0]}
+    assert batch.available_quantity == 19
+
+
+def test_order_lines_share_their_sku_and_order_id_strings():
+    sku = "".join(["ROUND", "-TABLE"])
+    line = OrderLine("".join(["order", "-123"]), sku, qty=2)
+    batch = Batch("batch-001", "".join(["ROUND", "-TABLE"]), 20, eta=None)
+
+    assert line.sku is batch.sku
+    assert line.order_id is OrderLine("order-123", "ROUND-TABLE", 5).order_id
+
+
+def test_order_lines_are_value_objects():
+    line = OrderLine("order-123", "ROUND-TABLE", qty=2)
+
+    assert line == OrderLine("order-123", "ROUND-TABLE", qty=2)
+    assert hash(line) == hash(OrderLine("order-123", "ROUND-TABLE", qty=2))
+    assert {line, OrderLine("order-123", "ROUND-TABLE", qty=2)} == {line}
@@ -0,0 +1,27 @@
+import pytest
+from allocation import config
+
+
+def test_replicas_default_to_the_shards(monkeypatch):
+    monkeypatch.setenv("DB_SHARD_URIS", "postgresql://a, postgresql://b")
+    monkeypatch.delenv("DB_REPLICA_URIS", raising=False)
+
+    assert config.get_replica_uris() == ["postgresql://a", "postgresql://b"]
+
+
+def test_there_has_to_be_a_replica_for_every_shard(monkeypatch):
+    monkeypatch.setenv("DB_SHARD_URIS", "postgresql://a,postgresql://b")
+    monkeypatch.setenv("DB_REPLICA_URIS", "postgresql://a-replica")
+
+    with pytest.raises(ValueError, match="1 databases for 2 shards"):
+        config.get_replica_uris()
+
+
+def test_an_unsharded_database_takes_one_replica(monkeypatch):
+    monkeypatch.delenv("DB_SHARD_URIS", raising=False)
+    monkeypatch.setenv("DB_REPLICA_URIS", "postgresql://r1,postgresql://r2")
+
+    with pytest.raises(ValueError):
+        config.get_replica_uris()
+    monkeypatch.setenv("DB_REPLICA_URIS", "postgresql://r1")
+    assert config.get_replica_uris() == ["postgresql://r1"]
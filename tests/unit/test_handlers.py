@@ -1,13 +1,18 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+import threading
+import time
 from typing import Iterable, Dict, List
 from unittest import mock
 from collections import defaultdict, deque
 import pytest
+from sqlalchemy.orm.exc import StaleDataError
 from allocation import bootstrap
 from allocation.adapters import repository
 from allocation.adapters.notifications import AbstractNotifications
-from allocation.domain import model, commands
-from allocation.service_layer import handlers, unit_of_work
+from allocation.domain import commands, events, model
+from allocation.service_layer import handlers, message_bus, unit_of_work
 
 today = date.today()
 
@@ -82,6 +87,17 @@ class TestAddBatch:
             for b in message_bus.uow.products.get("SIMPLE-LAMP").batches
         ]
 
+    def test_add_batch_rejects_duplicate_reference(self):
+        message_bus = bootstrap_test_app()
+        message_bus.handle(
+            commands.CreateBatch("batch1", "SIMPLE-LAMP", 100, None),
+        )
+
+        with pytest.raises(model.DuplicateBatch, match="batch1"):
+            message_bus.handle(
+                commands.CreateBatch("batch1", "SIMPLE-LAMP", 50, None),
+            )
+
 
 class TestAllocate:
     def test_allocates(self):
@@ -131,6 +147,32 @@ class TestAllocate:
         ]
 
 
+class TestAllocateMany:
+    def test_allocates_every_line(self):
+        message_bus = bootstrap_test_app()
+        message_bus.handle(
+            commands.CreateBatch("batch1", "SIMPLE-LAMP", 100, None)
+        )
+
+        message_bus.handle(
+            commands.AllocateMany(
+                "SIMPLE-LAMP", [("order1", 10), ("order2", 20)]
+            )
+        )
+
+        [batch] = message_bus.uow.products.get("SIMPLE-LAMP").batches
+        assert batch.available_quantity == 70
+        assert message_bus.uow.committed is True
+
+    def test_errors_for_invalid_sku(self):
+        message_bus = bootstrap_test_app()
+
+        with pytest.raises(handlers.InvalidSku, match="NONEXISTINGSKU"):
+            message_bus.handle(
+                commands.AllocateMany("NONEXISTINGSKU", [("order1", 10)])
+            )
+
+
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
         message_bus = bootstrap_test_app()
@@ -170,3 +212,229 @@ class TestChangeBatchQuantity:
         # the deallocated order will be allocated to the other available batch
         # batch(50) - order(20) = batch(30)
         assert batch2.available_quantity == 30
+
+    def test_uses_the_configured_deallocation_policy(self):
+        released = []
+
+        def release_everything(lines, shortfall):
+            released.extend(lines)
+            return list(lines)
+
+        message_bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            message_queue_factory=deque,
+            publish=lambda *args, **kwargs: None,
+            deallocation_policy=release_everything,
+        )
+        sku = "FLAT-TABLE"
+        for message in [
+            commands.CreateBatch("batch1", sku, 50, None),
+            commands.Allocate("order1", sku, 20),
+            commands.Allocate("order2", sku, 20),
+        ]:
+            message_bus.handle(message)
+
+        message_bus.handle(commands.ChangeBatchQuantity("batch1", sku, 30))
+
+        assert len(released) == 2
+
+
+class TestRetries:
+    @staticmethod
+    def bus_with_allocate_handler(handler, **retry_policy):
+        return message_bus.MessageBus(
+            uow=FakeUnitOfWork(),
+            message_queue_factory=deque,
+            event_handlers={},
+            command_handlers={commands.Allocate: handler},
+            retry_policy=message_bus.RetryPolicy(backoff=0, **retry_policy),
+        )
+
+    def test_retries_commands_that_lost_a_race(self):
+        calls = []
+
+        def handler(command):
+            calls.append(command)
+            if len(calls) < 3:
+                raise StaleDataError("version changed")
+
+        bus = self.bus_with_allocate_handler(handler)
+        bus.handle(commands.Allocate("order1", "LAMP", 10))
+
+        assert len(calls) == 3
+
+    def test_gives_up_after_the_configured_attempts(self):
+        calls = []
+
+        def handler(command):
+            calls.append(command)
+            raise StaleDataError("version changed")
+
+        bus = self.bus_with_allocate_handler(handler, attempts=2)
+        with pytest.raises(StaleDataError):
+            bus.handle(commands.Allocate("order1", "LAMP", 10))
+
+        assert len(calls) == 2
+
+    def test_does_not_retry_other_errors(self):
+        calls = []
+
+        def handler(command):
+            calls.append(command)
+            raise handlers.InvalidSku("Invalid sku LAMP")
+
+        bus = self.bus_with_allocate_handler(handler)
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("order1", "LAMP", 10))
+
+        assert len(calls) == 1
+
+
+class TestEventCollection:
+    def test_collects_events_in_the_order_they_were_raised(self):
+        uow = FakeUnitOfWork()
+        lamp = model.Product("LAMP", [model.Batch("b1", "LAMP", 10, None)])
+        chair = model.Product("CHAIR", [model.Batch("b2", "CHAIR", 10, None)])
+        uow.products.add(lamp)
+        uow.products.add(chair)
+
+        lamp.allocate(model.OrderLine("o1", "LAMP", 1))
+        chair.allocate(model.OrderLine("o2", "CHAIR", 1))
+        lamp.allocate(model.OrderLine("o3", "LAMP", 1))
+
+        assert [e.order_id for e in uow.collect_new_events()] == [
+            "o1",
+            "o2",
+            "o3",
+        ]
+        assert lamp.events == chair.events == []
+        assert list(uow.collect_new_events()) == []
+
+    def test_keeps_events_raised_before_the_product_was_seen(self):
+        uow = FakeUnitOfWork()
+        product = model.Product("LAMP", [])
+        product.events.append(events.OutOfStock("LAMP"))
+
+        uow.products.add(product)
+        product.events.extend([events.OutOfStock("LAMP")])
+
+        assert len(list(uow.collect_new_events())) == 2
+
+
+class TestConcurrentEventHandlers:
+    @staticmethod
+    def bus_with_event_handlers(*event_handlers):
+        return message_bus.MessageBus(
+            uow=FakeUnitOfWork(),
+            message_queue_factory=deque,
+            event_handlers={events.Allocated: list(event_handlers)},
+            command_handlers={},
+            executor=ThreadPoolExecutor(4),
+        )
+
+    @staticmethod
+    def not_using_uow(handler):
+        handler.uses_uow = False
+        return handler
+
+    def test_runs_handlers_without_the_uow_alongside_the_rest(self):
+        started = threading.Barrier(3, timeout=5)
+        handled = []
+
+        @self.not_using_uow
+        def publish(event):
+            started.wait()
+            handled.append("publish")
+
+        @self.not_using_uow
+        def notify(event):
+            started.wait()
+            handled.append("notify")
+
+        def project(event):
+            started.wait()
+            handled.append("project")
+
+        bus = self.bus_with_event_handlers(publish, project, notify)
+        bus.handle(events.Allocated("o1", "LAMP", 10, "b1"))
+
+        assert sorted(handled) == ["notify", "project", "publish"]
+
+    def test_a_failing_handler_does_not_stop_the_others(self):
+        handled = []
+
+        @self.not_using_uow
+        def publish(event):
+            raise ConnectionError("redis is down")
+
+        def project(event):
+            handled.append(event)
+
+        bus = self.bus_with_event_handlers(publish, project)
+        bus.handle(events.Allocated("o1", "LAMP", 10, "b1"))
+
+        assert len(handled) == 1
+
+    def test_queues_new_events_in_handler_order(self):
+        uow = FakeUnitOfWork()
+        lamp = model.Product("LAMP", [model.Batch("b1", "LAMP", 10, None)])
+        chair = model.Product("CHAIR", [model.Batch("b2", "CHAIR", 10, None)])
+        uow.products.add(lamp)
+        uow.products.add(chair)
+        list(uow.collect_new_events())
+        handled = []
+
+        @self.not_using_uow
+        def publish(event):
+            time.sleep(0.01)
+
+        def allocate_lamp(event):
+            lamp.allocate(model.OrderLine("o2", "LAMP", 1))
+
+        def allocate_chair(event):
+            chair.allocate(model.OrderLine("o3", "CHAIR", 1))
+
+        bus = message_bus.MessageBus(
+            uow=uow,
+            message_queue_factory=deque,
+            event_handlers={
+                events.Deallocated: [publish, allocate_lamp, allocate_chair],
+                events.Allocated: [handled.append],
+            },
+            command_handlers={},
+            executor=ThreadPoolExecutor(2),
+        )
+        bus.handle(events.Deallocated("o1", "LAMP", 1))
+
+        assert [event.order_id for event in handled] == ["o2", "o3"]
+
+
+class TestAsyncMessageBus:
+    def test_a_failing_handler_does_not_stop_the_others(self):
+        handled = []
+
+        async def publish_allocated_event(event, publish):
+            raise ConnectionError("redis is down")
+
+        async def add_allocation_to_read_model(event, uow):
+            handled.append(event)
+
+        dependencies = {"uow": FakeUnitOfWork(), "publish": None}
+        bus = message_bus.AsyncMessageBus(
+            uow=dependencies["uow"],
+            event_handlers={
+                events.Allocated: [
+                    bootstrap.inject_dependencies(handler, dependencies)
+                    for handler in [
+                        publish_allocated_event,
+                        add_allocation_to_read_model,
+                    ]
+                ]
+            },
+            command_handlers={},
+        )
+        asyncio.run(bus.handle(events.Allocated("o1", "LAMP", 10, "b1")))
+
+        assert len(handled) == 1
@@ -0,0 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from allocation.adapters import notifications
+
+
+class FakeSMTP:
+    """Records sends, and whether any two of them overlapped."""
+
+    def __init__(self, host, port) -> None:
+        self.sent = []
+        self.overlapped = False
+        self._sending = False
+        self._lock = threading.Lock()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        with self._lock:
+            self.overlapped |= self._sending
+            self._sending = True
+        time.sleep(0.001)
+        self.sent.append(msg)
+        self._sending = False
+
+
+def test_emails_sent_from_many_threads_go_out_one_at_a_time(monkeypatch):
+    monkeypatch.setattr(notifications.smtplib, "SMTP", FakeSMTP)
+    email = notifications.EmailNotifications("localhost", 25)
+
+    with ThreadPoolExecutor(8) as pool:
+        list(
+            pool.map(
+                lambda i: email.send("test@example.com", f"message {i}"),
+                range(50),
+            )
+        )
+
+    assert len(email.server.sent) == 50
+    assert not email.server.overlapped
@@ -0,0 +1,38 @@
+import gc
+import os
+import weakref
+from allocation.adapters.process_local import ProcessLocal
+
+
+def test_creates_the_value_on_first_use_only():
+    created = []
+    local = ProcessLocal(lambda: created.append(object()) or created[-1])
+
+    assert created == []
+    first = local.get()
+    assert local.get() is first
+    assert len(created) == 1
+
+
+def test_creates_the_value_again_after_a_fork(monkeypatch):
+    local = ProcessLocal(object)
+    parent_value = local.get()
+
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+
+    assert local.get() is not parent_value
+    assert local.get() is local.get()
+
+
+def test_keeps_what_it_inherited_after_a_fork(monkeypatch):
+    class Pool:
+        pass
+
+    local = ProcessLocal(Pool)
+    inherited = weakref.ref(local.get())
+
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+    local.get()
+    gc.collect()
+
+    assert inherited() is not None
@@ -1,5 +1,8 @@
+import random
+import pytest
 from datetime import date, timedelta
-from allocation.domain import events
+from typing import List
+from allocation.domain import events, model
 from allocation.domain.model import Batch, OrderLine, Product
 
 today = date.today()
@@ -67,3 +70,241 @@ def test_increments_version_number():
     product.allocate(line)
 
     assert product.version_number == 3
+
+
+def test_prefers_earlier_batches_added_later():
+    sku = "MINIMALIST-SPOON"
+    medium = Batch("normal-batch", sku, 100, eta=tomorrow)
+    product = Product(sku, [medium])
+    product.allocate(OrderLine("order1", sku, 10))
+
+    earliest = Batch("speedy-batch", sku, 100, eta=today)
+    product.add_batch(earliest)
+    allocation = product.allocate(OrderLine("order2", sku, 10))
+
+    assert allocation == earliest.reference
+    assert product.batches == [medium, earliest]
+
+
+def test_skips_exhausted_batches():
+    sku = "RETRO-CLOCK"
+    in_stock_batch = Batch("in-stock-batch", sku, 10, eta=None)
+    shipment_batch = Batch("shipment-batch", sku, 100, eta=tomorrow)
+    product = Product(sku, [shipment_batch, in_stock_batch])
+
+    assert product.allocate(OrderLine("order1", sku, 10)) == "in-stock-batch"
+    assert product.allocate(OrderLine("order2", sku, 10)) == "shipment-batch"
+
+
+def test_allocates_to_a_batch_again_once_its_quantity_goes_up():
+    sku = "RETRO-CLOCK"
+    in_stock_batch = Batch("in-stock-batch", sku, 10, eta=None)
+    shipment_batch = Batch("shipment-batch", sku, 100, eta=tomorrow)
+    product = Product(sku, [in_stock_batch, shipment_batch])
+    product.allocate(OrderLine("order1", sku, 10))
+
+    product.change_batch_quantity("in-stock-batch", sku, 20)
+
+    assert product.allocate(OrderLine("order2", sku, 10)) == "in-stock-batch"
+
+
+def test_batches_with_the_same_eta_keep_their_order():
+    sku = "HIGHBROWPOSTER"
+    first = Batch("first-batch", sku, 100, eta=tomorrow)
+    second = Batch("second-batch", sku, 100, eta=tomorrow)
+    product = Product(sku, [first, second])
+
+    assert product.allocate(OrderLine("order1", sku, 10)) == "first-batch"
+
+
+def make_product(seed: int) -> Product:
+    rng = random.Random(seed)
+    etas = [None, today, tomorrow, later]
+    batches = [
+        Batch(
+            f"batch-{i}", "SMALL-TABLE", rng.randint(0, 60), rng.choice(etas)
+        )
+        for i in range(20)
+    ]
+    return Product("SMALL-TABLE", batches)
+
+
+def test_allocate_many_matches_allocating_one_line_at_a_time():
+    for seed in range(20):
+        rng = random.Random(seed)
+        lines = [
+            OrderLine(f"order-{rng.randint(0, 200)}", sku, rng.randint(0, 12))
+            for sku in rng.choices(
+                ["SMALL-TABLE", "LARGE-TABLE"], [9, 1], k=300
+            )
+        ]
+        one_by_one, in_bulk = make_product(seed), make_product(seed)
+
+        expected = [one_by_one.allocate(line) for line in lines]
+        assert in_bulk.allocate_many(lines) == expected
+
+        assert in_bulk.events == one_by_one.events
+        assert in_bulk.version_number == one_by_one.version_number
+        assert [b.available_quantity for b in in_bulk.batches] == [
+            b.available_quantity for b in one_by_one.batches
+        ]
+
+
+def test_allocate_many_without_batches_records_out_of_stock_events():
+    product = Product("SMALL-TABLE", batches=[])
+
+    lines = [OrderLine("o1", "SMALL-TABLE", 1), OrderLine("o2", "CHAIR", 1)]
+    assert product.allocate_many(lines) == [None, None]
+
+    assert product.events == [
+        events.OutOfStock("SMALL-TABLE"),
+        events.OutOfStock("CHAIR"),
+    ]
+
+
+def test_change_batch_quantity_deallocates_the_fewest_lines():
+    sku = "SMALL-TABLE"
+    batch = Batch("batch1", sku, 100, eta=None)
+    product = Product(sku, [batch])
+    for order_id, qty in [("small1", 5), ("small2", 5), ("big", 30)]:
+        product.allocate(OrderLine(order_id, sku, qty))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", sku, 20)
+
+    assert product.events == [events.Deallocated("big", sku, 30)]
+    assert batch.available_quantity == 10
+
+
+def test_change_batch_quantity_takes_a_deallocation_policy():
+    sku = "SMALL-TABLE"
+    batch = Batch("batch1", sku, 100, eta=None)
+    product = Product(sku, [batch])
+    for order_id in ["order1", "order2", "order3"]:
+        product.allocate(OrderLine(order_id, sku, 10))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", sku, 15, policy=model.any_lines)
+
+    assert len(product.events) == 2
+    assert batch.available_quantity == 5
+
+
+def test_cannot_add_a_batch_with_a_duplicate_reference():
+    sku = "SMALL-TABLE"
+    product = Product(sku, [Batch("batch1", sku, 10, eta=None)])
+
+    with pytest.raises(model.DuplicateBatch, match="batch1"):
+        product.add_batch(Batch("batch1", sku, 20, eta=tomorrow))
+
+    assert len(product.batches) == 1
+
+
+def test_change_batch_quantity_finds_batches_added_later():
+    sku = "SMALL-TABLE"
+    product = Product(sku, [Batch("batch1", sku, 10, eta=None)])
+    later_batch = Batch("batch2", sku, 10, eta=tomorrow)
+    product.add_batch(later_batch)
+
+    product.change_batch_quantity("batch2", sku, 50)
+
+    assert later_batch.available_quantity == 50
+
+
+def test_change_batch_quantity_rejects_unknown_references():
+    sku = "SMALL-TABLE"
+    product = Product(sku, [Batch("batch1", sku, 10, eta=None)])
+
+    with pytest.raises(model.UnknownBatch, match="batch2"):
+        product.change_batch_quantity("batch2", sku, 50)
+
+
+def test_finds_batches_in_a_replaced_list_of_the_same_length():
+    sku = "SMALL-TABLE"
+    product = Product(sku, [Batch("batch1", sku, 10, eta=None)])
+    product.change_batch_quantity("batch1", sku, 20)
+    reloaded = Batch("batch1", sku, 10, eta=None)
+
+    product.batches = [reloaded]
+    product.change_batch_quantity("batch1", sku, 30)
+
+    assert reloaded.available_quantity == 30
+
+
+def test_keeps_its_lookup_when_references_repeat():
+    sku = "SMALL-TABLE"
+    product = Product(
+        sku,
+        [Batch("batch1", sku, 10, eta=None), Batch("batch1", sku, 10, None)],
+    )
+    product.change_batch_quantity("batch1", sku, 20)
+    lookup = product._batch_lookup
+
+    product.change_batch_quantity("batch1", sku, 30)
+
+    assert product._batch_lookup is lookup
+
+
+def replay(product: Product, seed: int) -> List:
+    rng = random.Random(seed)
+    results = []
+    for i in range(200):
+        action = rng.random()
+        if action < 0.1:
+            product.add_batch(
+                Batch(
+                    f"new-batch-{i}",
+                    "SMALL-TABLE",
+                    rng.randint(0, 60),
+                    rng.choice([None, today, later]),
+                )
+            )
+        elif action < 0.2:
+            batch = rng.choice(product.batches)
+            product.change_batch_quantity(
+                batch.reference, "SMALL-TABLE", rng.randint(0, 60)
+            )
+        else:
+            line = OrderLine(f"order-{i}", "SMALL-TABLE", rng.randint(0, 12))
+            results.append(product.allocate(line))
+    return results
+
+
+def test_columnar_products_allocate_the_same_way():
+    for seed in range(20):
+        by_object, by_column = make_product(seed), make_product(seed)
+        by_column.COLUMNAR_THRESHOLD = 0
+
+        assert replay(by_column, seed) == replay(by_object, seed)
+
+        assert isinstance(by_column._batch_order, model.BatchColumns)
+        assert by_column.events == by_object.events
+        assert by_column.version_number == by_object.version_number
+
+
+def test_columnar_products_check_the_batch_they_pick():
+    sku = "SMALL-TABLE"
+    early = Batch("early", sku, 10, eta=None)
+    late = Batch("late", sku, 10, eta=tomorrow)
+    product = Product(sku, [early, late])
+    product.COLUMNAR_THRESHOLD = 0
+    product.allocate(OrderLine("order1", sku, 0))
+
+    # changed behind the columns' back
+    early._allocated_quantity = 10
+    reference = product.allocate(OrderLine("order2", sku, 10))
+
+    assert reference == "late"
+    assert product.events[-1] == events.Allocated("order2", sku, 10, "late")
+    assert late.available_quantity == 0
+
+
+def test_every_change_increments_version_number():
+    sku = "SMALL-TABLE"
+    product = Product(sku, [Batch("batch1", sku, 100, eta=None)])
+
+    product.add_batch(Batch("batch2", sku, 100, eta=tomorrow))
+    assert product.version_number == 1
+
+    product.change_batch_quantity("batch1", sku, 50)
+    assert product.version_number == 2
@@ -0,0 +1,81 @@
+import random
+from datetime import date, timedelta
+from allocation.domain import events
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.simulation import Snapshot
+
+today = date.today()
+tomorrow = today + timedelta(days=1)
+
+
+def make_products(seed: int):
+    rng = random.Random(seed)
+    products = []
+    for sku in ["SMALL-TABLE", "LARGE-TABLE"]:
+        batches = [
+            Batch(
+                f"{sku}-batch-{i}",
+                sku,
+                rng.randint(0, 80),
+                rng.choice([None, today, tomorrow]),
+            )
+            for i in range(15)
+        ]
+        products.append(Product(sku, batches))
+    # some stock already spoken for before the snapshot is taken
+    products[0].allocate(OrderLine("order-1", "SMALL-TABLE", 5))
+    return products
+
+
+def test_simulation_matches_allocating_each_line():
+    for seed in range(20):
+        rng = random.Random(seed)
+        lines = [
+            OrderLine(f"order-{rng.randint(0, 100)}", sku, rng.randint(0, 15))
+            for sku in rng.choices(["SMALL-TABLE", "LARGE-TABLE"], k=300)
+        ]
+        products = {p.sku: p for p in make_products(seed)}
+
+        result = Snapshot(products.values()).simulate(lines)
+
+        for product in products.values():
+            product.events.clear()
+        expected = [products[line.sku].allocate(line) for line in lines]
+        assert result.batch_refs == expected
+        out_of_stock = [
+            (i, line.sku)
+            for i, line in enumerate(lines)
+            if expected[i] is None
+        ]
+        assert result.out_of_stock == out_of_stock
+        fresh = {p.sku: p for p in make_products(seed)}
+        for product in products.values():
+            for batch in product.batches:
+                before = fresh[product.sku]._batches_by_reference()[
+                    batch.reference
+                ]
+                consumed = batch.allocated_quantity - before.allocated_quantity
+                assert result.consumption.get(batch.reference, 0) == consumed
+
+
+def test_simulation_does_not_change_the_products():
+    sku = "SMALL-TABLE"
+    batch = Batch("batch1", sku, 10, eta=None)
+    product = Product(sku, [batch])
+
+    result = Snapshot([product]).simulate(
+        [OrderLine("order1", sku, 6), OrderLine("order2", sku, 6)]
+    )
+
+    assert result.batch_refs == ["batch1", None]
+    assert result.out_of_stock == [(1, sku)]
+    assert result.fill_rate(sku) == 0.5
+    assert batch.available_quantity == 10
+    assert product.events == []
+
+
+def test_lines_for_unknown_skus_are_not_filled():
+    result = Snapshot([]).simulate([OrderLine("order1", "NO-SUCH-SKU", 6)])
+
+    assert result.batch_refs == [None]
+    assert result.fill_rate() == 0.0